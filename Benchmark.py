@@ -0,0 +1,333 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import time
+import numba
+import numpy as np
+
+from numba import config
+
+from FMM import FMMForces
+from Gravity import DirectForces, TreeForces
+from InitialCond import Compute_IC
+from QuadTree import Tree, Quad, Bounds
+from Simulation import Simulation
+
+
+def best_time(func, repeat = 3):
+    """
+    Best wall time of 'repeat' calls of 'func'.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t1)
+    return best
+
+def scaling(N_0, workers_list, theta = 0.8, seed = 10000, repeat = 3):
+    """
+    Time the force evaluation on 'N_0' bodies for every number of threads in 'workers_list'.
+    Also checks that the accelerations do not depend on the number of threads.
+    """
+    particles = Compute_IC(N_0, seed = seed)
+    center, w = Bounds(particles)
+    tree = Tree(Quad(center, w, particles, _theta = theta))
+    tree.createTree()
+
+    rows = []
+    reference = None
+    for workers in workers_list:
+        particles.computeForce(tree, workers)                 # Compile and warm up
+        t = best_time(lambda: particles.computeForce(tree, workers), repeat)
+        if reference is None:
+            reference = particles.acc.copy()
+        rows.append((workers, t, rows[0][1] / t if rows else 1.0, np.array_equal(reference, particles.acc)))
+
+    print(f'Force evaluation, N = {N_0}, theta = {theta}')
+    print(f'{"workers":>8} {"time [s]":>10} {"speedup":>8} {"identical":>10}')
+    for workers, t, speedup, same in rows:
+        print(f'{workers:>8} {t:>10.4f} {speedup:>8.2f} {str(same):>10}')
+    return rows
+
+global STARTUP
+STARTUP = """
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {path!r})
+import Main
+from Simulation import Simulation
+t1 = time.perf_counter()
+particles = Main.Compute_IC({N_0}, seed = {seed}, cache = None)
+t2 = time.perf_counter()
+Simulation(particles, engine = {engine!r}).step()
+t3 = time.perf_counter()
+print(json.dumps(dict(imports = t1 - t0, ic = t2 - t1, first_step = t3 - t2, pygame = 'pygame' in sys.modules)))
+"""
+
+def startup(N_0 = 1000, repeat = 3, engine = 'bh', seed = 10000):
+    """
+    Startup time of a fresh process: imports of the modules of Main.py and of Simulation, initial conditions of
+    'N_0' bodies and first step, which compiles the kernels or loads them from the cache of numba (see
+    Warmup.py), and wall time of the whole process. The first of the 'repeat' processes shows the state of the
+    cache, the best one the time with a filled cache. pygame must not be imported before a window is opened.
+    """
+    import subprocess
+    import sys
+    code = STARTUP.format(path = os.path.dirname(os.path.abspath(__file__)), N_0 = N_0, seed = seed, engine = engine)
+    rows = []
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code], capture_output = True, text = True, check = True)
+        row = json.loads(out.stdout.strip().splitlines()[-1])
+        row['process'] = time.perf_counter() - t1
+        rows.append(row)
+
+    names = ('imports', 'ic', 'first_step', 'process')
+    print(f'Startup, N = {N_0}, engine {engine}, pygame imported: {any(row["pygame"] for row in rows)}')
+    print(f'{"":>6} ' + ' '.join(f'{name:>11}' for name in names))
+    print(f'{"first":>6} ' + ' '.join(f'{rows[0][name]:>11.3f}' for name in names))
+    print(f'{"best":>6} ' + ' '.join(f'{min(row[name] for row in rows):>11.3f}' for name in names))
+    return rows
+
+def reference_forces(particles, targets = None):
+    """
+    Exact accelerations of the bodies 'targets' (all if None) from Gravity.DirectForces(), leaving
+    'particles.acc' as it was.
+    """
+    acc = particles.acc.copy()
+    DirectForces(particles, targets)
+    reference = particles.acc if targets is None else particles.acc[targets]
+    reference, particles.acc[:] = reference.copy(), acc
+    return reference
+
+def compare_engines(N_0, thetas = (0.3, 0.5, 0.7), orders = (2, 4, 6), leaf_size = 8, seed = 10000, repeat = 3,
+                    workers = None):
+    """
+    Accuracy against cost of the Barnes-Hut walk (monopole and quadrupole) and of the FMM (every order in
+    'orders'), for every opening angle in 'thetas' (the separation criterion of the FMM). The error is |a - a_direct| / |a_direct|, the reference
+    being the direct sum over all the pairs.
+    """
+    particles = Compute_IC(N_0, seed = seed)
+    reference = reference_forces(particles)
+
+    center, w = Bounds(particles)
+
+    rows = []
+    for theta in thetas:
+        for engine, param in [('bh', 1), ('bh', 2)] + [('fmm', order) for order in orders]:
+            tree = Tree(Quad(center, w, particles, _theta = theta), multipole = param if engine == 'bh' else 1,
+                        leaf_size = leaf_size)
+            tree.createTree()
+            if engine == 'bh':
+                func = lambda: TreeForces(tree, particles, workers = workers)
+            else:
+                func = lambda: FMMForces(tree, particles, workers = workers, order = param, theta = theta)
+            func()                                              # Compile and warm up
+            t = best_time(func, repeat)
+            err = np.linalg.norm(particles.acc - reference, axis = 1) / np.linalg.norm(reference, axis = 1)
+            rows.append((engine, param, theta, t, np.sqrt(np.mean(err**2)), np.percentile(err, 99)))
+
+    print(f'Accuracy against cost, N = {N_0}, leaf size = {leaf_size}')
+    print(f'{"engine":>6} {"order":>6} {"theta":>6} {"time [s]":>10} {"rms err":>10} {"p99 err":>10}')
+    for engine, param, theta, t, rms, p99 in rows:
+        print(f'{engine:>6} {param:>6} {theta:>6} {t:>10.4f} {rms:>10.2e} {p99:>10.2e}')
+    return rows
+
+def compare_precision(N_0, theta = 0.8, multipole = 1, leaf_size = 1, seed = 10000, repeat = 3, workers = None,
+                      n_ref = 2000):
+    """
+    Time, memory read by the walk (Tree.walk_bytes()) and force error against the direct sum on 'n_ref' bodies
+    of the tree walk with the tree in double and in single precision, see Tree.store(). The last column is
+    the largest change of the accelerations between the two, relative to the double precision ones.
+    """
+    particles = Compute_IC(N_0, seed = seed)
+    ref_idx = np.arange(N_0) if N_0 <= n_ref else np.sort(np.random.default_rng(seed).choice(N_0, n_ref, False))
+    reference = reference_forces(particles, ref_idx)
+
+    rows, acc = [], {}
+    for precision in ('float64', 'float32'):
+        center, w = Bounds(particles)
+        tree = Tree(Quad(center, w, particles, _theta = theta), multipole = multipole, leaf_size = leaf_size,
+                    precision = precision)
+        tree.createTree()
+        TreeForces(tree, particles, workers = workers)              # Compile and warm up
+        t = best_time(lambda: TreeForces(tree, particles, workers = workers), repeat)
+        acc[precision] = particles.acc[ref_idx].copy()
+        err = np.linalg.norm(acc[precision] - reference, axis = 1) / np.linalg.norm(reference, axis = 1)
+        change = np.max(np.linalg.norm(acc[precision] - acc['float64'], axis = 1) /
+                        np.linalg.norm(acc['float64'], axis = 1))
+        rows.append((precision, t, tree.walk_bytes(), np.sqrt(np.mean(err**2)), np.percentile(err, 99), change))
+
+    print(f'Precision of the tree, N = {N_0}, theta = {theta}, multipole = {multipole}, leaf size = {leaf_size}')
+    print(f'{"":>8} {"time [s]":>10} {"speedup":>8} {"walk [MB]":>10} {"rms err":>10} {"p99 err":>10} {"max change":>11}')
+    for precision, t, nbytes, rms, p99, change in rows:
+        print(f'{precision:>8} {t:>10.4f} {rows[0][1] / t:>8.2f} {nbytes / 2**20:>10.2f} {rms:>10.2e} {p99:>10.2e} '
+              f'{change:>11.2e}')
+    return rows
+
+global FIELDS
+FIELDS = ('N', 'theta', 'workers', 'multipole', 'leaf_size', 'seed', 'build', 'forces', 'step', 'rms', 'p99',
+          'n_ref')
+
+def suite(N_list, thetas, workers_list, multipole = 1, leaf_size = 1, seed = 10000, repeat = 3, n_ref = 2000,
+          path = None):
+    """
+    Benchmark of the Barnes-Hut engine on Compute_IC() initial conditions with the seed 'seed', for every N in
+    'N_list', opening angle in 'thetas' and number of threads in 'workers_list'. Every row has the best times of
+    'repeat' runs of
+        - build  : Bounds() and Tree.createTree() on the initial conditions, the root of Simulation.updateTree()
+        - forces : TreeForces() on all the bodies
+        - step   : Simulation.step(), tree update, forces and integration from the initial conditions
+    and the RMS and 99th percentile of the relative force error against the direct sum, on 'n_ref' bodies
+    chosen at random (all of them if N <= n_ref). Rows are written to 'path' as CSV or JSON (.json), with
+    the versions and the machine in the JSON case, see compare().
+    """
+    rows = []
+    for N_0 in N_list:
+        particles = Compute_IC(N_0, seed = seed)
+        ref_idx = np.arange(N_0) if N_0 <= n_ref else np.sort(np.random.default_rng(seed).choice(N_0, n_ref, False))
+        reference = reference_forces(particles, ref_idx)
+        for theta in thetas:
+            for workers in workers_list:
+                def build():
+                    center, w = Bounds(particles)
+                    tree = Tree(Quad(center, w, particles, _theta = theta), multipole = multipole,
+                                leaf_size = leaf_size)
+                    tree.createTree()
+                    return tree
+                tree = build()                                      # Compile and warm up
+                TreeForces(tree, particles, workers = workers)
+                t_build  = best_time(build, repeat)
+                t_forces = best_time(lambda: TreeForces(tree, particles, workers = workers), repeat)
+                err = np.linalg.norm(particles.acc[ref_idx] - reference, axis = 1) / np.linalg.norm(reference, axis = 1)
+
+                t_step = np.inf
+                for _ in range(repeat + 1):                         # The first one compiles
+                    sim = Simulation(particles[np.arange(N_0)], theta = theta, workers = workers,
+                                     multipole = multipole, leaf_size = leaf_size)
+                    t1 = time.perf_counter()
+                    sim.step()
+                    t_step = min(t_step, time.perf_counter() - t1)
+
+                rows.append(dict(N = N_0, theta = theta, workers = workers, multipole = multipole,
+                                 leaf_size = leaf_size, seed = seed, build = t_build, forces = t_forces, step = t_step,
+                                 rms = float(np.sqrt(np.mean(err**2))), p99 = float(np.percentile(err, 99)),
+                                 n_ref = len(ref_idx)))
+                r = rows[-1]
+                print(f'N = {N_0:>8}  theta = {theta:<5} workers = {workers:>3}   build {r["build"]:.4f} s   '
+                      f'forces {r["forces"]:.4f} s   step {r["step"]:.4f} s   rms {r["rms"]:.2e}   '
+                      f'p99 {r["p99"]:.2e}', flush = True)
+    if path is not None:
+        write_results(rows, path)
+    return rows
+
+def write_results(rows, path):
+    """
+    Write the rows of suite() to 'path', as JSON with the machine and the versions if it ends with .json,
+    as CSV otherwise.
+    """
+    if path.endswith('.json'):
+        meta = dict(machine = platform.machine(), processor = platform.processor(), python = platform.python_version(),
+                    numpy = np.__version__, numba = numba.__version__, threads = config.NUMBA_NUM_THREADS,
+                    date = time.strftime('%Y-%m-%d %H:%M:%S'))
+        with open(path, 'w') as handle:
+            json.dump(dict(meta = meta, rows = rows), handle, indent = 1)
+    else:
+        with open(path, 'w', newline = '') as handle:
+            writer = csv.DictWriter(handle, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+def read_results(path):
+    if path.endswith('.json'):
+        with open(path) as handle:
+            return json.load(handle)['rows']
+    with open(path, newline = '') as handle:
+        return [{key: float(value) for key, value in row.items()} for row in csv.DictReader(handle)]
+
+def compare(base, new):
+    """
+    Compare two result files of suite(): time ratios new / base (< 1 is faster) and errors, on the rows with the
+    same N, theta, workers, multipole, leaf size and seed.
+    """
+    key = lambda row: tuple(float(row[name]) for name in ('N', 'theta', 'workers', 'multipole', 'leaf_size', 'seed'))
+    base = {key(row): row for row in read_results(base)}
+    print(f'{"N":>8} {"theta":>6} {"workers":>7} {"build":>7} {"forces":>7} {"step":>7} '
+          f'{"rms base":>9} {"rms new":>9} {"p99 base":>9} {"p99 new":>9}')
+    for row in read_results(new):
+        old = base.get(key(row))
+        if old is None:
+            continue
+        ratio = lambda name: float(row[name]) / float(old[name])
+        print(f'{int(row["N"]):>8} {float(row["theta"]):>6} {int(row["workers"]):>7} {ratio("build"):>7.3f} '
+              f'{ratio("forces"):>7.3f} {ratio("step"):>7.3f} {float(old["rms"]):>9.2e} {float(row["rms"]):>9.2e} '
+              f'{float(old["p99"]):>9.2e} {float(row["p99"]):>9.2e}')
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the gravity engine.')
+    parser.add_argument('-N', type = int, nargs = '+', default = None,
+                        help = 'numbers of bodies (default: 100000, 1000 with --startup)')
+    parser.add_argument('--theta', type = float, nargs = '+', default = [0.8], help = 'opening angles')
+    parser.add_argument('--workers', type = int, nargs = '+', default = None,
+                        help = 'numbers of threads to test (default: 1, 2, 4, ... up to all the cores)')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'repetitions of every measurement')
+    parser.add_argument('--engines', action = 'store_true',
+                        help = 'compare the accuracy and cost of Barnes-Hut and FMM instead of the thread scaling')
+    parser.add_argument('--precision', action = 'store_true',
+                        help = 'compare time, memory and force error of the tree in double and single precision')
+    parser.add_argument('--suite', action = 'store_true',
+                        help = 'time build, forces and step and measure the force errors for every N, theta and workers')
+    parser.add_argument('--multipole', type = int, choices = (1, 2), default = 1, help = 'multipole order of the suite')
+    parser.add_argument('--leaf-size', type = int, default = 1, help = 'leaf size of the suite')
+    parser.add_argument('--seed', type = int, default = 10000, help = 'seed of the initial conditions')
+    parser.add_argument('--n-ref', type = int, default = 2000, help = 'bodies checked against the direct sum')
+    parser.add_argument('--out', default = None, help = 'write the results of the suite to this .csv or .json file')
+    parser.add_argument('--compare', nargs = 2, metavar = ('BASE', 'NEW'), help = 'compare two result files')
+    parser.add_argument('--startup', action = 'store_true',
+                        help = 'time imports, initial conditions and first step of fresh processes')
+    parser.add_argument('--max-startup', type = float, default = None,
+                        help = 'with --startup, fail if the best process takes longer than this, in seconds')
+    args = parser.parse_args()
+    if args.N is None:
+        args.N = [1000] if args.startup else [100000]
+
+    if args.startup:
+        rows = startup(args.N[0], args.repeat, seed = args.seed)
+        best = min(row['process'] for row in rows)
+        if args.max_startup is not None and (best > args.max_startup or rows[0]['pygame']):
+            print(f'Startup regression: {best:.3f} s (limit {args.max_startup} s)')
+            raise SystemExit(1)
+        raise SystemExit
+
+    if args.compare is not None:
+        compare(*args.compare)
+        raise SystemExit
+
+    if args.precision:
+        compare_precision(args.N[0], args.theta[0], args.multipole, args.leaf_size, args.seed, args.repeat,
+                          args.workers[0] if args.workers else None, args.n_ref)
+        raise SystemExit
+
+    if args.engines:
+        compare_engines(args.N[0], repeat = args.repeat, workers = args.workers[0] if args.workers else None)
+        raise SystemExit
+
+    workers_list = args.workers
+    if workers_list is None:
+        workers_list = [1]
+        while workers_list[-1] * 2 < config.NUMBA_NUM_THREADS:
+            workers_list.append(workers_list[-1] * 2)
+        if workers_list[-1] != config.NUMBA_NUM_THREADS:
+            workers_list.append(config.NUMBA_NUM_THREADS)
+
+    if args.suite:
+        suite(args.N, args.theta, workers_list, args.multipole, args.leaf_size, args.seed, args.repeat, args.n_ref,
+              args.out)
+    else:
+        scaling(args.N[0], workers_list, args.theta[0], repeat = args.repeat)
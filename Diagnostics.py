@@ -0,0 +1,77 @@
+import csv
+import json
+import numpy as np
+
+from Gravity import TreePotential
+
+
+global FIELDS
+FIELDS = ('step', 't', 'N', 'K', 'W', 'E', 'dE', 'Px', 'Py', 'Lz', 'virial')
+
+
+def Measure(sim):
+    """
+    Conserved quantities of the Simulation() 'sim', on the bodies that are not skipped:
+            - K, W, E : kinetic, potential (from the tree, with the softening of the forces) and total energy
+            - Px, Py  : linear momentum
+            - Lz      : angular momentum around the origin
+            - virial  : 2 K / |W|, 1 for a system in virial equilibrium
+    W = 1/2 sum m_i phi_i costs one tree walk, O(N log N). With the Verlet integrator the velocities are
+    (x_n+1 - x_n) / dt, half a step behind the positions, which shows up as a small oscillation of K.
+    """
+    p = sim.particles
+    tree = sim.updateTree()
+    idx = np.flatnonzero(~p.skip)
+    m, x, v = p.mass[idx], p.pos[idx], p.vel[idx]
+
+    K = 0.5 * np.sum(m * (v[:, 0]**2 + v[:, 1]**2))
+    W = 0.5 * np.sum(m * TreePotential(tree, p, idx, sim.workers))
+    Px, Py = m @ v
+    Lz = np.sum(m * (x[:, 0] * v[:, 1] - x[:, 1] * v[:, 0]))
+    return dict(step = sim.n_step, t = sim.t, N = len(idx), K = K, W = W, E = K + W, Px = Px, Py = Py, Lz = Lz,
+                virial = 2 * K / abs(W) if W != 0 else np.nan)
+
+
+class Diagnostics():
+    """
+    Time series of Measure() every 'every' steps, written to 'path' as CSV or as JSON lines (.jsonl) as soon
+    as it is measured. dE is the drift of the total energy relative to the first record, (E - E_0) / |E_0|.
+    With path None the records are only kept in 'rows'.
+    """
+
+    def __init__(self, path = None, every = 10):
+        self.path  = path
+        self.every = every
+        self.rows  = []
+        self.E_0   = None
+        self._file = None
+        if path is not None:
+            self._file = open(path, 'w', newline = '')
+            if not path.endswith('.jsonl'):
+                self._csv = csv.DictWriter(self._file, FIELDS)
+                self._csv.writeheader()
+
+    def record(self, sim, force = False):
+        """
+        Measure 'sim' if its step is a multiple of 'every' (or if 'force'). Returns the record or None.
+        """
+        if not force and sim.n_step % self.every != 0:
+            return None
+        row = Measure(sim)
+        if self.E_0 is None:
+            self.E_0 = row['E']
+        row['dE'] = (row['E'] - self.E_0) / abs(self.E_0) if self.E_0 != 0 else 0.
+        row = {key: (row[key].item() if isinstance(row[key], np.generic) else row[key]) for key in FIELDS}
+        self.rows.append(row)
+        if self._file is not None:
+            if self.path.endswith('.jsonl'):
+                self._file.write(json.dumps(row) + '\n')
+            else:
+                self._csv.writerow(row)
+            self._file.flush()
+        return row
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,165 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+import traceback
+import multiprocessing as mp
+import numpy as np
+
+from contextlib import redirect_stdout, redirect_stderr
+from numba import config
+
+# The runs are forked from a process that already compiled and launched the kernels: only the workqueue
+# threading layer of numba survives a fork once its threads are running (TBB hangs, GNU OpenMP aborts).
+config.THREADING_LAYER = 'workqueue'
+
+from Headless import parse_args, run
+
+
+global SUMMARY, WARMUP_KEYS
+SUMMARY = ('run', 'status', 'wall', 'step_time', 'N_end', 'mergers', 'escaped', 'dE_end', 'dE_max')
+WARMUP_KEYS = ('engine', 'integrator', 'multipole', 'leaf_size')   # Settings that select different kernels
+
+
+def expand(spec):
+    """
+    List of the settings of the runs of a sweep specification, a dict with
+        - base  : settings shared by all the runs, with the names of the options of Headless.py ('N', 'seed',
+                  'theta', 'dt', 'steps', 'integrator', ...)
+        - sweep : lists of values, one run for every combination of them
+    """
+    base, sweep = spec.get('base', {}), spec.get('sweep', {})
+    known = vars(parse_args([]))
+    unknown = [key for key in list(base) + list(sweep) if key not in known]
+    if unknown:
+        raise ValueError(f'Unknown settings {unknown}, see the options of Headless.py')
+    keys = list(sweep)
+    return [dict(base, **dict(zip(keys, values))) for values in itertools.product(*(sweep[key] for key in keys))]
+
+def run_one(k, settings, root, threads = 1):
+    """
+    Run 'settings' with Headless.run() in the directory root/run_k, with its settings.json, the log of the run,
+    the diagnostics and the trajectory. Returns the row of the summary, with the error in 'status' if it failed.
+    """
+    path = os.path.join(root, f'run_{k:04d}')
+    os.makedirs(path, exist_ok = True)
+    with open(os.path.join(path, 'settings.json'), 'w') as handle:
+        json.dump(settings, handle, indent = 1)
+
+    args = parse_args([])
+    for key, value in settings.items():
+        setattr(args, key, value)
+    args.workers = threads
+    args.diagnostics = os.path.join(path, 'diagnostics.csv')
+    args.save = os.path.join(path, 'trajectory.nbody')
+
+    row = dict(run = k, **settings)
+    t0 = time.time()
+    with open(os.path.join(path, 'run.log'), 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            sim = run(args)
+        except Exception as error:
+            traceback.print_exc()
+            row['status'] = f'error: {error!r}'
+            return row
+    wall = time.time() - t0
+
+    with open(args.diagnostics) as handle:
+        dE = np.array([float(line['dE']) for line in csv.DictReader(handle)])
+    row.update(status = 'ok', wall = wall, step_time = wall / max(1, sim.n_step), N_end = len(sim.particles),
+               mergers = sim.fused, escaped = sim.n_escaped, dE_end = dE[-1], dE_max = np.abs(dE).max())
+    return row
+
+def _run_one(job):
+    return run_one(*job)
+
+def warm_up(runs, root):
+    """
+    Compile the kernels used by 'runs' with a short run for every combination of the WARMUP_KEYS settings,
+    so that the forked runs start with them compiled.
+    """
+    seen = []
+    for settings in runs:
+        key = tuple(settings.get(name) for name in WARMUP_KEYS)
+        if key in seen:
+            continue
+        seen.append(key)
+        small = dict(settings, N = 64, steps = 2, t_end = None, load = None)
+        run_one(len(seen) - 1, small, os.path.join(root, 'warmup'))
+
+def sweep(spec, root = 'ensemble', processes = None, threads = 1):
+    """
+    Run all the runs of the sweep specification 'spec' (see expand()) on a process pool of 'processes' workers
+    (as many as the cores allow with 'threads' threads per run if None), each run in its own directory of 'root'.
+    The kernels are compiled once before the pool is forked, and the initial conditions are shared through
+    the cache of InitialCond.Compute_IC(). The summary of every run is written to root/summary.csv as soon as
+    it ends. Returns the rows of the summary, sorted by run.
+    """
+    runs = expand(spec)
+    processes = processes or max(1, (os.cpu_count() or 1) // threads)
+    os.makedirs(root, exist_ok = True)
+    with open(os.path.join(root, 'spec.json'), 'w') as handle:
+        json.dump(spec, handle, indent = 1)
+
+    fork = 'fork' in mp.get_all_start_methods()
+    if fork:
+        t0 = time.time()
+        warm_up(runs, root)
+        print(f'Kernels compiled in {time.time() - t0:.1f} s')
+    ctx = mp.get_context('fork' if fork else 'spawn')
+
+    keys = list(spec.get('sweep', {}))
+    fields = ['run'] + keys + [name for name in SUMMARY if name != 'run']
+    rows = []
+    print(f'{len(runs)} runs on {processes} processes with {threads} threads each')
+    with open(os.path.join(root, 'summary.csv'), 'w', newline = '') as handle, ctx.Pool(processes) as pool:
+        writer = csv.DictWriter(handle, fields, extrasaction = 'ignore')
+        writer.writeheader()
+        jobs = [(k, settings, root, threads) for k, settings in enumerate(runs)]
+        for row in pool.imap_unordered(_run_one, jobs):
+            rows.append(row)
+            writer.writerow(row)
+            handle.flush()
+            print(f'run {row["run"]:>4}  {" ".join(f"{key}={row[key]}" for key in keys)}  {row["status"]}'
+                  + (f'  {row["wall"]:.1f} s  dE/E = {row["dE_end"]:+.3e}' if row['status'] == 'ok' else ''))
+        pool.close()
+        pool.join()
+    rows.sort(key = lambda row: row['run'])
+    print(aggregate(rows, [key for key in keys if key != 'seed']))
+    return rows
+
+def aggregate(rows, keys):
+    """
+    Table of the runs grouped by the settings 'keys' (over seeds, typically): number of runs, mean wall time
+    and time per step, mean and maximum of the largest energy error |dE/E| of each run.
+    """
+    groups = {}
+    for row in rows:
+        if row['status'] == 'ok':
+            groups.setdefault(tuple(row[key] for key in keys), []).append(row)
+    lines = [' '.join(f'{key:>10}' for key in keys) + f' {"runs":>5} {"wall [s]":>9} {"step [ms]":>10} '
+             f'{"mean |dE|":>10} {"max |dE|":>10}']
+    for group, members in sorted(groups.items(), key = lambda item: str(item[0])):
+        dE = np.array([row['dE_max'] for row in members])
+        lines.append(' '.join(f'{str(value):>10}' for value in group) + f' {len(members):>5} '
+                     f'{np.mean([row["wall"] for row in members]):>9.2f} '
+                     f'{1e3 * np.mean([row["step_time"] for row in members]):>10.3f} '
+                     f'{dE.mean():>10.2e} {dE.max():>10.2e}')
+    failed = len(rows) - sum(len(members) for members in groups.values())
+    if failed:
+        lines.append(f'{failed} runs failed, see their run.log')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run a sweep of headless simulations on a process pool.')
+    parser.add_argument('spec', help = 'JSON file with the "base" settings and the "sweep" lists of values')
+    parser.add_argument('--out', default = 'ensemble', help = 'output directory, one subdirectory per run')
+    parser.add_argument('--processes', type = int, default = None, help = 'parallel runs (default: cores / threads)')
+    parser.add_argument('--threads', type = int, default = 1, help = 'threads of every run')
+    args = parser.parse_args()
+    with open(args.spec) as handle:
+        spec = json.load(handle)
+    sweep(spec, args.out, args.processes, args.threads)
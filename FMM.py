@@ -0,0 +1,345 @@
+import numpy as np
+from numba import njit, prange
+
+from Gravity import G, a2, SetWorkers, _tree_forces
+
+
+global FMM_THETA
+FMM_THETA = 0.4                   # Separation criterion of the node pairs, see FMMForces()
+
+
+def FMMForces(tree, particles, targets = None, workers = None, order = 4, theta = FMM_THETA):
+    """
+    Compute the accelerations of the bodies 'targets' (all the bodies not skipped if None) with the Fast
+    Multipole Method on the nodes of 'tree', writing them in 'particles.acc'.
+
+    The kernel is the same softened 1 / sqrt(r^2 + a2) of the tree walk (G and a2 of Gravity.py, passed to
+    the kernels as arguments), expanded in Cartesian Taylor series of total degree 'order' about the centers
+    of mass of the nodes:
+        - P2M, M2M: multipole moments of the leaves, shifted up to the root
+        - a dual tree walk pairs the nodes: well separated pairs, (r_A + r_B) < theta d_AB with r the radius
+          of a node around its center of mass, interact through M2L, pairs of leaves directly (P2P). This
+          'theta' is not the opening angle of the tree (tree.theta): the test on the radii of both nodes is
+          looser than the Barnes-Hut one for the same value, and needs a smaller one for the same accuracy
+        - L2L, L2P: local expansions shifted down to the leaves and evaluated on their bodies.
+    Bodies outside the tree get their forces from the Barnes-Hut walk. The expansions are computed in double
+    precision also on a single precision tree.
+    Returns the number of M2L and P2P node pairs.
+    """
+    SetWorkers(workers)
+    if targets is None:
+        targets = np.flatnonzero(~particles.skip)
+    pos, mass, acc = particles.pos, particles.mass, particles.acc
+    child, leaf, start, end = tree.node_child, tree.node_leaf, tree.node_start, tree.node_end
+    cm, M = tree.node_cm.astype(np.float64, copy = False), tree.node_mass.astype(np.float64, copy = False)
+
+    ka, kb = _indices(order)
+    index  = _index_table(ka, kb, order)
+    binom  = _binomials(order)
+
+    radius = _radii(pos, tree.order, child, leaf, start, end, cm, M)
+    Mc = _upward(pos, mass, tree.order, child, leaf, start, end, cm, M, ka, kb, index, binom)
+    m2l, p2p = _dual_walk(child, leaf, start, end, cm, M, radius, theta)
+    m2l = m2l[np.argsort(m2l[:, 0], kind = 'stable')]
+    p2p = p2p[np.argsort(p2p[:, 0], kind = 'stable')]
+    Lc = _m2l(m2l, _segments(m2l[:, 0]), cm, Mc, ka, kb, index, binom, order, float(a2))
+    _downward(Lc, child, leaf, cm, ka, kb, index, binom)
+
+    field = np.zeros_like(acc)
+    _l2p(pos, tree.order, leaf, start, end, cm, Lc, ka, kb, index, field, float(G))
+    _p2p(pos, mass, tree.order, start, end, p2p, _segments(p2p[:, 0]), field, float(G), float(a2))
+
+    is_target = np.zeros(len(particles), dtype = np.bool_)
+    is_target[targets] = True
+    in_tree = tree.order[is_target[tree.order]]
+    acc[in_tree] = field[in_tree]
+    is_target[tree.order] = False
+    outside = np.flatnonzero(is_target)
+    if len(outside) > 0:
+        _tree_forces(pos, mass, outside, tree.order, child, leaf, start, end, tree.node_w, cm, M,
+                     tree.node_quad.astype(np.float64, copy = False),
+                     tree.multipole, tree.theta, acc)
+    return len(m2l), len(p2p)
+
+
+def _indices(order):
+    """
+    Multi-indices (a, b), a + b <= order, of the expansion coefficients.
+    """
+    ka = np.array([a for n in range(order + 1) for a in range(n, -1, -1)], dtype = np.int64)
+    kb = np.array([n - a for n in range(order + 1) for a in range(n, -1, -1)], dtype = np.int64)
+    return ka, kb
+
+def _index_table(ka, kb, order):
+    """
+    Position of the coefficient (a, b) in the flat arrays, -1 if a + b > order.
+    """
+    index = np.full((order + 1, order + 1), -1, dtype = np.int64)
+    index[ka, kb] = np.arange(len(ka))
+    return index
+
+def _binomials(order):
+    binom = np.zeros((order + 1, order + 1))
+    for n in range(order + 1):
+        binom[n, 0] = 1
+        for k in range(1, n + 1):
+            binom[n, k] = binom[n - 1, k - 1] + binom[n - 1, k]
+    return binom
+
+def _segments(keys):
+    """
+    Start of every run of equal values in the sorted 'keys', followed by len(keys).
+    """
+    if len(keys) == 0:
+        return np.zeros(1, dtype = np.int64)
+    return np.concatenate(([0], np.flatnonzero(np.diff(keys) != 0) + 1, [len(keys)])).astype(np.int64)
+
+
+@njit(cache = True)
+def _grow(a, size):
+    """
+    Local copy of QuadTree._grow(), see Gravity._grow().
+    """
+    out = np.empty((size,) + a.shape[1:], dtype = a.dtype)
+    out[:a.shape[0]] = a
+    return out
+
+@njit(cache = True)
+def _is_leaf(node, leaf, start, end):
+    return leaf[node] or end[node] - start[node] <= 1
+
+@njit(cache = True)
+def _powers(dx, dy, order, px, py):
+    px[0], py[0] = 1.0, 1.0
+    for n in range(1, order + 1):
+        px[n] = px[n - 1] * dx
+        py[n] = py[n - 1] * dy
+
+@njit(cache = True)
+def _radii(pos, order, child, leaf, start, end, cm, M):
+    """
+    Radius of every node: maximum distance of its bodies from its center of mass.
+    """
+    n_nodes = child.shape[0]
+    radius = np.zeros(n_nodes)
+    for node in range(n_nodes - 1, -1, -1):
+        if M[node] == 0:
+            continue
+        r = 0.0
+        if leaf[node]:
+            for k in range(start[node], end[node]):
+                i = order[k]
+                r = max(r, np.sqrt((pos[i, 0] - cm[node, 0])**2 + (pos[i, 1] - cm[node, 1])**2))
+        else:
+            for q in range(4):
+                c = child[node, q]
+                if c >= 0 and M[c] > 0:
+                    d = np.sqrt((cm[c, 0] - cm[node, 0])**2 + (cm[c, 1] - cm[node, 1])**2)
+                    r = max(r, d + radius[c])
+        radius[node] = r
+    return radius
+
+@njit(cache = True)
+def _upward(pos, mass, order, child, leaf, start, end, cm, M, ka, kb, index, binom):
+    """
+    P2M on the leaves and M2M up to the root: M_k = sum m (y - c)^k about the center of mass c of every node.
+    """
+    p = index.shape[0] - 1
+    K = len(ka)
+    n_nodes = child.shape[0]
+    Mc = np.zeros((n_nodes, K))
+    px, py = np.empty(p + 1), np.empty(p + 1)
+    for node in range(n_nodes - 1, -1, -1):
+        if M[node] == 0:
+            continue
+        if leaf[node]:
+            for k in range(start[node], end[node]):
+                i = order[k]
+                _powers(pos[i, 0] - cm[node, 0], pos[i, 1] - cm[node, 1], p, px, py)
+                for c in range(K):
+                    Mc[node, c] += mass[i] * px[ka[c]] * py[kb[c]]
+        else:
+            for q in range(4):
+                ch = child[node, q]
+                if ch < 0 or M[ch] == 0:
+                    continue
+                _powers(cm[ch, 0] - cm[node, 0], cm[ch, 1] - cm[node, 1], p, px, py)
+                for c in range(K):
+                    a, b = ka[c], kb[c]
+                    s = 0.0
+                    for ja in range(a + 1):
+                        for jb in range(b + 1):
+                            s += binom[a, ja] * binom[b, jb] * Mc[ch, index[ja, jb]] * px[a - ja] * py[b - jb]
+                    Mc[node, c] += s
+    return Mc
+
+@njit(cache = True)
+def _dual_walk(child, leaf, start, end, cm, M, radius, theta):
+    """
+    Dual tree walk from the pair (root, root). Returns the (target, source) node pairs interacting through
+    M2L and through P2P.
+    """
+    m2l = np.empty((1024, 2), dtype = np.int64)
+    p2p = np.empty((1024, 2), dtype = np.int64)
+    stack = np.empty((1024, 2), dtype = np.int64)
+    n_m2l, n_p2p = 0, 0
+    stack[0, 0], stack[0, 1] = 0, 0
+    top = 1
+    while top > 0:
+        top -= 1
+        A, B = stack[top, 0], stack[top, 1]
+        if M[A] == 0 or M[B] == 0:
+            continue
+        leafA, leafB = _is_leaf(A, leaf, start, end), _is_leaf(B, leaf, start, end)
+        d = np.sqrt((cm[A, 0] - cm[B, 0])**2 + (cm[A, 1] - cm[B, 1])**2)
+        if A != B and radius[A] + radius[B] < theta * d:
+            if n_m2l == len(m2l):
+                m2l = _grow(m2l, 2 * n_m2l)
+            m2l[n_m2l, 0], m2l[n_m2l, 1] = A, B
+            n_m2l += 1
+            continue
+        if leafA and leafB:
+            if n_p2p == len(p2p):
+                p2p = _grow(p2p, 2 * n_p2p)
+            p2p[n_p2p, 0], p2p[n_p2p, 1] = A, B
+            n_p2p += 1
+            continue
+        if top + 16 > len(stack):
+            stack = _grow(stack, 2 * len(stack))
+        if A == B:                                                  # Split both
+            for qa in range(4):
+                for qb in range(4):
+                    if child[A, qa] >= 0 and child[B, qb] >= 0:
+                        stack[top, 0], stack[top, 1] = child[A, qa], child[B, qb]
+                        top += 1
+        elif leafB or (not leafA and radius[A] >= radius[B]):      # Split the target
+            for q in range(4):
+                if child[A, q] >= 0:
+                    stack[top, 0], stack[top, 1] = child[A, q], B
+                    top += 1
+        else:                                                       # Split the source
+            for q in range(4):
+                if child[B, q] >= 0:
+                    stack[top, 0], stack[top, 1] = A, child[B, q]
+                    top += 1
+    return m2l[:n_m2l].copy(), p2p[:n_p2p].copy()
+
+@njit(cache = True)
+def _kernel_derivatives(dx, dy, p, b, a2):
+    """
+    b[a, c] = (-1)^(a+c) / (a! c!) d^a/dx^a d^c/dy^c of 1 / sqrt(dx^2 + dy^2 + a2), from the recurrence
+    n R^2 b_k = (2n - 1) sum_i d_i b_{k - e_i} - (n - 1) sum_i b_{k - 2 e_i},  n = |k|.
+    """
+    R2 = dx**2 + dy**2 + a2
+    b[0, 0] = 1 / np.sqrt(R2)
+    for n in range(1, p + 1):
+        for a in range(n, -1, -1):
+            c = n - a
+            s = 0.0
+            if a > 0:
+                s += (2 * n - 1) * dx * b[a - 1, c]
+            if c > 0:
+                s += (2 * n - 1) * dy * b[a, c - 1]
+            if a > 1:
+                s -= (n - 1) * b[a - 2, c]
+            if c > 1:
+                s -= (n - 1) * b[a, c - 2]
+            b[a, c] = s / (n * R2)
+
+@njit(parallel = True, cache = True)
+def _m2l(m2l, segments, cm, Mc, ka, kb, index, binom, p, a2):
+    """
+    M2L, grouped by target node: L_n = (-1)^|n| sum_k C(k + n, n) M_k b_{k+n}(c_A - c_B), |k| + |n| <= p.
+    """
+    n_nodes, K = Mc.shape
+    Lc = np.zeros((n_nodes, K))
+    for s in prange(len(segments) - 1):
+        b = np.empty((p + 1, p + 1))
+        A = m2l[segments[s], 0]
+        for pair in range(segments[s], segments[s + 1]):
+            B = m2l[pair, 1]
+            _kernel_derivatives(cm[A, 0] - cm[B, 0], cm[A, 1] - cm[B, 1], p, b, a2)
+            for c in range(K):
+                na, nb = ka[c], kb[c]
+                total = 0.0
+                for k in range(K):
+                    a, bb = ka[k], kb[k]
+                    if a + bb + na + nb > p:
+                        break
+                    total += binom[a + na, na] * binom[bb + nb, nb] * Mc[B, k] * b[a + na, bb + nb]
+                Lc[A, c] += total if (na + nb) % 2 == 0 else -total
+    return Lc
+
+@njit(cache = True)
+def _downward(Lc, child, leaf, cm, ka, kb, index, binom):
+    """
+    L2L from the root to the leaves: L'_m = sum_{n >= m} C(n, m) L_n (c' - c)^(n - m).
+    """
+    p = index.shape[0] - 1
+    K = len(ka)
+    px, py = np.empty(p + 1), np.empty(p + 1)
+    for node in range(child.shape[0]):
+        if leaf[node]:
+            continue
+        for q in range(4):
+            ch = child[node, q]
+            if ch < 0:
+                continue
+            _powers(cm[ch, 0] - cm[node, 0], cm[ch, 1] - cm[node, 1], p, px, py)
+            for c in range(K):
+                ma, mb = ka[c], kb[c]
+                s = 0.0
+                for n in range(K):
+                    na, nb = ka[n], kb[n]
+                    if na >= ma and nb >= mb:
+                        s += binom[na, ma] * binom[nb, mb] * Lc[node, n] * px[na - ma] * py[nb - mb]
+                Lc[ch, c] += s
+
+@njit(parallel = True, cache = True)
+def _l2p(pos, order, leaf, start, end, cm, Lc, ka, kb, index, field, G):
+    """
+    Evaluate the local expansions of the leaves on their bodies: a = G grad sum_n L_n (x - c)^n.
+    """
+    p = index.shape[0] - 1
+    K = len(ka)
+    for node in prange(len(leaf)):
+        if not leaf[node]:
+            continue
+        px, py = np.empty(p + 1), np.empty(p + 1)
+        for k in range(start[node], end[node]):
+            i = order[k]
+            _powers(pos[i, 0] - cm[node, 0], pos[i, 1] - cm[node, 1], p, px, py)
+            aX, aY = 0.0, 0.0
+            for c in range(K):
+                a, b = ka[c], kb[c]
+                if a > 0:
+                    aX += Lc[node, c] * a * px[a - 1] * py[b]
+                if b > 0:
+                    aY += Lc[node, c] * b * px[a] * py[b - 1]
+            field[i, 0] = G * aX
+            field[i, 1] = G * aY
+
+@njit(parallel = True, cache = True)
+def _p2p(pos, mass, order, start, end, p2p, segments, field, G, a2):
+    """
+    Direct interactions of the leaf pairs, grouped by target node.
+    """
+    for s in prange(len(segments) - 1):
+        A = p2p[segments[s], 0]
+        for pair in range(segments[s], segments[s + 1]):
+            B = p2p[pair, 1]
+            for k in range(start[A], end[A]):
+                i = order[k]
+                x, y = pos[i, 0], pos[i, 1]
+                aX, aY = 0.0, 0.0
+                for kk in range(start[B], end[B]):
+                    j = order[kk]
+                    if j == i:
+                        continue
+                    dx, dy = pos[j, 0] - x, pos[j, 1] - y
+                    r2 = dx * dx + dy * dy + a2
+                    f  = G * mass[j] / (r2 * np.sqrt(r2))
+                    aX += f * dx
+                    aY += f * dy
+                field[i, 0] += aX
+                field[i, 1] += aY
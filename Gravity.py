@@ -0,0 +1,553 @@
+import numpy as np
+from numba import njit, prange, config, set_num_threads
+
+
+global G, a2
+G  = 1
+a2 = 0.001
+
+global STACK, CHUNK, TILE, MIN_TILE, TILES, DIRECT_MAX_N
+STACK = 128                       # Size of the explicit stack of the tree walks, > 3 * MAX_DEPTH + 4
+CHUNK = 256                       # Bodies handled by a thread at a time
+TILE  = 256                       # Largest number of bodies in a tile of the direct sum
+MIN_TILE = 32                     # Smallest one
+TILES = 16                        # Tiles of the direct sum below TILES * TILE bodies, TILES / 2 pairs per round
+DIRECT_MAX_N = 2000               # With engine 'auto' the forces are summed directly up to this number of bodies
+                                  # (provisional: measured on a single core, more threads favour the direct sum)
+
+
+def SetWorkers(workers = None):
+    """
+    Set the number of threads of the compiled kernels, all the available cores if None.
+    Results do not depend on the number of threads: every body is always summed in the same order.
+    """
+    if workers is None:
+        workers = config.NUMBA_NUM_THREADS
+    set_num_threads(max(1, min(int(workers), config.NUMBA_NUM_THREADS)))
+
+
+def TreeForces(tree, particles, targets = None, workers = None):
+    """
+    Compute the accelerations of the bodies 'targets' (all the bodies not skipped if None) walking 'tree',
+    writing them in 'particles.acc'. The tree must have been built on 'particles'.
+    'workers' is the number of threads, see SetWorkers().
+    If the leaves of the tree hold more than one body (tree.leaf_size > 1) the tree is walked once per leaf,
+    see _group_forces(); the bodies outside the tree are always walked one by one.
+    The walk reads positions, masses and moments in the precision of the tree (see Tree.store()) and
+    accumulates the forces in double precision.
+    """
+    SetWorkers(workers)
+    if targets is None:
+        targets = np.flatnonzero(~particles.skip)
+    if tree.leaf_size > 1:
+        is_target = np.zeros(len(particles), dtype = np.bool_)
+        is_target[targets] = True
+        groups = _target_groups(is_target, tree.order, tree.node_leaf, tree.node_start, tree.node_end)
+        _group_forces(tree.walk_pos, tree.walk_mass, is_target, groups, tree.order, tree.node_child, tree.node_leaf,
+                      tree.node_start, tree.node_end, tree.node_w, tree.node_cm, tree.node_mass, tree.node_quad,
+                      tree.multipole, tree.theta, particles.acc)
+        is_target[tree.order] = False
+        targets = np.flatnonzero(is_target)
+    _tree_forces(tree.walk_pos, tree.walk_mass, targets, tree.order, tree.node_child, tree.node_leaf,
+                 tree.node_start, tree.node_end, tree.node_w, tree.node_cm, tree.node_mass, tree.node_quad,
+                 tree.multipole, tree.theta, particles.acc)
+
+def DirectForces(particles, targets = None, workers = None):
+    """
+    Exact accelerations of the bodies 'targets' (all the bodies not skipped if None), summing over all the
+    bodies that are not skipped with the softening of _Acceleration(), writing them in 'particles.acc'.
+    For all the bodies the sum is done once per pair, see _direct_symmetric(), on TILES tiles of at least
+    MIN_TILE bodies for small sets so that the rounds keep the threads busy, otherwise once per target.
+    Results do not depend on the number of threads.
+    """
+    SetWorkers(workers)
+    sources = np.flatnonzero(~particles.skip)
+    x, y = particles.pos[sources, 0].copy(), particles.pos[sources, 1].copy()
+    m = particles.mass[sources].copy()
+    if targets is None or (len(targets) == len(sources) and np.array_equal(np.sort(targets), sources)):
+        ax, ay = _direct_symmetric(x, y, m, min(TILE, max(MIN_TILE, len(m) // TILES)))
+        particles.acc[sources, 0], particles.acc[sources, 1] = ax, ay
+    else:
+        targets = np.asarray(targets)
+        particles.acc[targets] = _direct_targets(particles.pos[targets], x, y, m)
+
+def UseDirect(n, max_n = None):
+    """
+    Crossover of the engine 'auto': direct sum for at most 'max_n' bodies (DIRECT_MAX_N if None), tree walk above.
+    """
+    return n <= (DIRECT_MAX_N if max_n is None else max_n)
+
+
+def ClosePairs(tree, particles, h, workers = None):
+    """
+    For every body of 'tree', the index of the nearest other body of the tree closer than 'h', -1 if there is
+    none. Each body walks only the nodes whose square comes closer than 'h', so the search costs O(N log N).
+    """
+    SetWorkers(workers)
+    return _close_pairs(particles.pos, tree.order, tree.node_child, tree.node_leaf, tree.node_start, tree.node_end,
+                        tree.node_center, tree.node_w, float(h))
+
+
+def TreePotential(tree, particles, targets = None, workers = None):
+    """
+    Gravitational potential at the bodies 'targets' (all the bodies not skipped if None), with the same walk,
+    opening angle, multipoles and softening as the forces, see _tree_forces(). Returns an array of len(targets).
+    """
+    SetWorkers(workers)
+    if targets is None:
+        targets = np.flatnonzero(~particles.skip)
+    phi = np.zeros(len(targets))
+    _tree_potential(tree.walk_pos, tree.walk_mass, targets, tree.order, tree.node_child, tree.node_leaf,
+                    tree.node_start, tree.node_end, tree.node_w, tree.node_cm, tree.node_mass, tree.node_quad,
+                    tree.multipole, tree.theta, phi)
+    return phi
+
+def WalkStats(tree, particles, targets = None):
+    """
+    Counters of the walk done by TreeForces() for 'targets' (all the bodies not skipped if None): nodes opened,
+    body-node and body-body interactions. With tree.leaf_size > 1 the walks are the group walks, whose
+    interaction lists are shared by all the targets of a leaf. Costs about as much as the forces themselves.
+    """
+    if targets is None:
+        targets = np.flatnonzero(~particles.skip)
+    is_target = np.zeros(len(particles), dtype = np.bool_)
+    is_target[targets] = True
+    counts = np.zeros(3, dtype = np.int64)
+    if tree.leaf_size > 1:
+        groups = _target_groups(is_target, tree.order, tree.node_leaf, tree.node_start, tree.node_end)
+        _group_counts(tree.walk_pos, is_target, groups, tree.order, tree.node_child, tree.node_leaf,
+                      tree.node_start, tree.node_end, tree.node_w, tree.node_cm, tree.node_mass, tree.theta, counts)
+        is_target[tree.order] = False
+        targets = np.flatnonzero(is_target)
+    _walk_counts(tree.walk_pos, targets, tree.order, tree.node_child, tree.node_leaf, tree.node_start,
+                 tree.node_end, tree.node_w, tree.node_cm, tree.node_mass, tree.theta, counts)
+    return dict(opened = int(counts[0]), body_node = int(counts[1]), body_body = int(counts[2]))
+
+
+@njit(cache = True)
+def _grow(a, size):
+    """
+    Copy of QuadTree._grow(): a cached kernel must not call kernels of other modules, numba would not notice
+    when they change, see Warmup.py.
+    """
+    out = np.empty((size,) + a.shape[1:], dtype = a.dtype)
+    out[:a.shape[0]] = a
+    return out
+
+@njit(cache = True)
+def _Acceleration(selfx, selfy, othx, othy, mass):
+    r2 = (othx - selfx)**2 + (othy - selfy)**2
+    aX  =  G * mass * (othx - selfx) / (r2 + a2)**(3/2)
+    aY  =  G * mass * (othy - selfy) / (r2 + a2)**(3/2)
+    return aX, aY
+
+@njit(cache = True)
+def _QuadAcceleration(selfx, selfy, othx, othy, Q):
+    """
+    Acceleration due to the quadrupole Q = (Qxx, Qxy, Qyy) of a node with center of mass (othx, othy),
+    G (Q r / r^5 - 5/2 (r Q r) r / r^7) with r = self - oth, softened as the monopole.
+    """
+    rx, ry = selfx - othx, selfy - othy
+    r2  = rx**2 + ry**2 + a2
+    Qrx = Q[0] * rx + Q[1] * ry
+    Qry = Q[1] * rx + Q[2] * ry
+    rQr = rx * Qrx + ry * Qry
+    r5  = r2**(5/2)
+    aX  = G * (Qrx - 2.5 * rQr * rx / r2) / r5
+    aY  = G * (Qry - 2.5 * rQr * ry / r2) / r5
+    return aX, aY
+
+@njit(parallel = True, cache = True)
+def _tree_forces(pos, mass, targets, order, child, leaf, start, end, width, cm, M, Q, multipole, theta, acc):
+    """
+    Barnes-Hut walk of the flat tree for every body in 'targets', using an explicit stack.
+    A node with more than one body acts through its center of mass if width / d <= theta,
+    d being the distance between the body and the center of mass, adding its quadrupole if multipole > 1.
+    The bodies are split in chunks of CHUNK that run in parallel.
+    """
+    n = len(targets)
+    for c in prange((n + CHUNK - 1) // CHUNK):
+        stack = np.empty(STACK, dtype = np.int64)
+        for k in range(c * CHUNK, min(n, (c + 1) * CHUNK)):
+            i = targets[k]
+            acc[i, 0], acc[i, 1] = _walk(i, pos, mass, order, child, leaf, start, end, width, cm, M, Q, multipole,
+                                         theta, stack)
+
+@njit(cache = True)
+def _walk(i, pos, mass, order, child, leaf, start, end, width, cm, M, Q, multipole, theta, stack):
+    """
+    Acceleration of the body 'i', see _tree_forces().
+    """
+    x, y = pos[i, 0], pos[i, 1]
+    aX, aY = 0.0, 0.0
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if M[node] == 0:
+            continue
+        if end[node] - start[node] > 1 and not leaf[node]:
+            dx, dy = cm[node, 0] - x, cm[node, 1] - y
+            if width[node] <= theta * np.sqrt(dx**2 + dy**2):     # Act through the center of mass
+                ax, ay = _Acceleration(x, y, cm[node, 0], cm[node, 1], M[node])
+                aX += ax
+                aY += ay
+                if multipole > 1:
+                    ax, ay = _QuadAcceleration(x, y, cm[node, 0], cm[node, 1], Q[node])
+                    aX += ax
+                    aY += ay
+            else:                                                  # Open the node
+                for q in range(4):
+                    if child[node, q] >= 0:
+                        stack[top] = child[node, q]
+                        top += 1
+        else:                                                      # Sum directly over the bodies of the leaf
+            for kk in range(start[node], end[node]):
+                j = order[kk]
+                if j == i:
+                    continue                                       # Avoid computing forces on itself
+                ax, ay = _Acceleration(x, y, pos[j, 0], pos[j, 1], mass[j])
+                aX += ax
+                aY += ay
+    return aX, aY
+
+@njit(parallel = True, cache = True)
+def _direct_symmetric(x, y, m, tile):
+    """
+    Direct sum over all the pairs, each pair computed once and applied to both bodies. The bodies are split in
+    tiles of 'tile' bodies: the pairs within a tile run in parallel, then the pairs of tiles are scheduled in the rounds
+    of a round-robin tournament, where every tile appears at most once per round, so that the tile pairs of a
+    round run in parallel without write conflicts, always summed in the same order.
+    """
+    n = len(m)
+    ax, ay = np.zeros(n), np.zeros(n)
+    B = (n + tile - 1) // tile
+    for b in prange(B):
+        _tile_self(x, y, m, ax, ay, b * tile, min(n, (b + 1) * tile))
+    P = B + B % 2                                                   # Even number of slots, with a dummy tile
+    for r in range(P - 1):
+        for k in prange(P // 2):
+            if k == 0:
+                I, J = r, P - 1
+            else:
+                I, J = (r + k) % (P - 1), (r - k + P - 1) % (P - 1)
+            if I < B and J < B:
+                _tile_pair(x, y, m, ax, ay, I * tile, min(n, (I + 1) * tile), J * tile, min(n, (J + 1) * tile))
+    return ax, ay
+
+@njit(fastmath = True, cache = True)
+def _tile_self(x, y, m, ax, ay, i0, i1):
+    for i in range(i0, i1):
+        xi, yi, mi = x[i], y[i], m[i]
+        sx, sy = 0.0, 0.0
+        for j in range(i + 1, i1):
+            dx, dy = x[j] - xi, y[j] - yi
+            r2 = dx * dx + dy * dy + a2
+            f  = G / (r2 * np.sqrt(r2))
+            sx += f * m[j] * dx
+            sy += f * m[j] * dy
+            ax[j] -= f * mi * dx
+            ay[j] -= f * mi * dy
+        ax[i] += sx
+        ay[i] += sy
+
+@njit(fastmath = True, cache = True)
+def _tile_pair(x, y, m, ax, ay, i0, i1, j0, j1):
+    for i in range(i0, i1):
+        xi, yi, mi = x[i], y[i], m[i]
+        sx, sy = 0.0, 0.0
+        for j in range(j0, j1):
+            dx, dy = x[j] - xi, y[j] - yi
+            r2 = dx * dx + dy * dy + a2
+            f  = G / (r2 * np.sqrt(r2))
+            sx += f * m[j] * dx
+            sy += f * m[j] * dy
+            ax[j] -= f * mi * dx
+            ay[j] -= f * mi * dy
+        ax[i] += sx
+        ay[i] += sy
+
+@njit(parallel = True, cache = True)
+def _direct_targets(pos, x, y, m):
+    """
+    Direct sum on the bodies at 'pos' from the sources (x, y, m), in chunks of CHUNK. A source at the same
+    position as the target (the body itself) gives no force thanks to the softening.
+    """
+    n = pos.shape[0]
+    acc = np.zeros((n, 2))
+    for c in prange((n + CHUNK - 1) // CHUNK):
+        for k in range(c * CHUNK, min(n, (c + 1) * CHUNK)):
+            acc[k, 0], acc[k, 1] = _sum_sources(pos[k, 0], pos[k, 1], x, y, m, len(m))
+    return acc
+
+@njit(parallel = True, cache = True)
+def _close_pairs(pos, order, child, leaf, start, end, center, width, h):
+    n = len(order)
+    partner = np.full(pos.shape[0], -1, dtype = np.int64)
+    for c in prange((n + CHUNK - 1) // CHUNK):
+        stack = np.empty(STACK, dtype = np.int64)
+        for k in range(c * CHUNK, min(n, (c + 1) * CHUNK)):
+            i = order[k]
+            x, y = pos[i, 0], pos[i, 1]
+            best = h * h
+            stack[0] = 0
+            top = 1
+            while top > 0:
+                top -= 1
+                node = stack[top]
+                reach = 0.5 * width[node] + h
+                if abs(center[node, 0] - x) > reach or abs(center[node, 1] - y) > reach:
+                    continue
+                if leaf[node]:
+                    for kk in range(start[node], end[node]):
+                        j = order[kk]
+                        d2 = (pos[j, 0] - x)**2 + (pos[j, 1] - y)**2
+                        if j != i and d2 < best:
+                            best = d2
+                            partner[i] = j
+                else:
+                    for q in range(4):
+                        if child[node, q] >= 0:
+                            stack[top] = child[node, q]
+                            top += 1
+    return partner
+
+@njit(cache = True)
+def _Potential(selfx, selfy, othx, othy, mass):
+    return - G * mass / np.sqrt((othx - selfx)**2 + (othy - selfy)**2 + a2)
+
+@njit(cache = True)
+def _QuadPotential(selfx, selfy, othx, othy, Q):
+    """
+    Potential of the quadrupole Q of a node, - G (r Q r) / (2 r^5), whose gradient is _QuadAcceleration().
+    """
+    rx, ry = selfx - othx, selfy - othy
+    r2  = rx**2 + ry**2 + a2
+    rQr = Q[0] * rx**2 + 2 * Q[1] * rx * ry + Q[2] * ry**2
+    return - G * rQr / (2 * r2**(5/2))
+
+@njit(parallel = True, cache = True)
+def _tree_potential(pos, mass, targets, order, child, leaf, start, end, width, cm, M, Q, multipole, theta, phi):
+    """
+    Potential of every body in 'targets', walking the tree as _tree_forces().
+    """
+    n = len(targets)
+    for c in prange((n + CHUNK - 1) // CHUNK):
+        stack = np.empty(STACK, dtype = np.int64)
+        for k in range(c * CHUNK, min(n, (c + 1) * CHUNK)):
+            phi[k] = _walk_potential(targets[k], pos, mass, order, child, leaf, start, end, width, cm, M, Q,
+                                     multipole, theta, stack)
+
+@njit(cache = True)
+def _walk_potential(i, pos, mass, order, child, leaf, start, end, width, cm, M, Q, multipole, theta, stack):
+    """
+    Potential at the body 'i', see _walk().
+    """
+    x, y = pos[i, 0], pos[i, 1]
+    phi = 0.0
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if M[node] == 0:
+            continue
+        if end[node] - start[node] > 1 and not leaf[node]:
+            dx, dy = cm[node, 0] - x, cm[node, 1] - y
+            if width[node] <= theta * np.sqrt(dx**2 + dy**2):
+                phi += _Potential(x, y, cm[node, 0], cm[node, 1], M[node])
+                if multipole > 1:
+                    phi += _QuadPotential(x, y, cm[node, 0], cm[node, 1], Q[node])
+            else:
+                for q in range(4):
+                    if child[node, q] >= 0:
+                        stack[top] = child[node, q]
+                        top += 1
+        else:
+            for kk in range(start[node], end[node]):
+                j = order[kk]
+                if j != i:
+                    phi += _Potential(x, y, pos[j, 0], pos[j, 1], mass[j])
+    return phi
+
+@njit(cache = True)
+def _walk_counts(pos, targets, order, child, leaf, start, end, width, cm, M, theta, counts):
+    """
+    Add to 'counts' the nodes opened, body-node and body-body interactions of _walk() for every target.
+    """
+    stack = np.empty(STACK, dtype = np.int64)
+    for k in range(len(targets)):
+        i = targets[k]
+        x, y = pos[i, 0], pos[i, 1]
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            if M[node] == 0:
+                continue
+            if end[node] - start[node] > 1 and not leaf[node]:
+                dx, dy = cm[node, 0] - x, cm[node, 1] - y
+                if width[node] <= theta * np.sqrt(dx**2 + dy**2):
+                    counts[1] += 1
+                else:
+                    counts[0] += 1
+                    for q in range(4):
+                        if child[node, q] >= 0:
+                            stack[top] = child[node, q]
+                            top += 1
+            else:
+                for kk in range(start[node], end[node]):
+                    if order[kk] != i:
+                        counts[2] += 1
+
+@njit(cache = True)
+def _group_counts(pos, is_target, groups, order, child, leaf, start, end, width, cm, M, theta, counts):
+    """
+    Same as _walk_counts() for the group walks of _group_walk().
+    """
+    stack = np.empty(STACK, dtype = np.int64)
+    for g in range(len(groups)):
+        group = groups[g]
+        n_targets = 0
+        xmin, ymin, xmax, ymax = np.inf, np.inf, -np.inf, -np.inf
+        for k in range(start[group], end[group]):
+            i = order[k]
+            xmin, xmax = min(xmin, pos[i, 0]), max(xmax, pos[i, 0])
+            ymin, ymax = min(ymin, pos[i, 1]), max(ymax, pos[i, 1])
+            if is_target[i]:
+                n_targets += 1
+        n_nodes, n_bodies = 0, 0
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            if M[node] == 0:
+                continue
+            if end[node] - start[node] > 1 and not leaf[node]:
+                dx = max(xmin - cm[node, 0], 0.0, cm[node, 0] - xmax)
+                dy = max(ymin - cm[node, 1], 0.0, cm[node, 1] - ymax)
+                if width[node] <= theta * np.sqrt(dx**2 + dy**2):
+                    n_nodes += 1
+                else:
+                    counts[0] += 1
+                    for q in range(4):
+                        if child[node, q] >= 0:
+                            stack[top] = child[node, q]
+                            top += 1
+            else:
+                n_bodies += end[node] - start[node]
+        counts[1] += n_targets * n_nodes
+        counts[2] += n_targets * n_bodies
+
+@njit(cache = True)
+def _target_groups(is_target, order, leaf, start, end):
+    """
+    Leaves holding at least one target body.
+    """
+    groups = np.empty(len(leaf), dtype = np.int64)
+    n = 0
+    for node in range(len(leaf)):
+        if not leaf[node]:
+            continue
+        for k in range(start[node], end[node]):
+            if is_target[order[k]]:
+                groups[n] = node
+                n += 1
+                break
+    return groups[:n]
+
+@njit(parallel = True, cache = True)
+def _group_forces(pos, mass, is_target, groups, order, child, leaf, start, end, width, cm, M, Q, multipole, theta, acc):
+    """
+    Group walk: the tree is walked once for every leaf in 'groups', see _group_walk(). Leaves run in parallel.
+    """
+    for g in prange(len(groups)):
+        _group_walk(groups[g], pos, mass, is_target, order, child, leaf, start, end, width, cm, M, Q, multipole,
+                    theta, acc)
+
+@njit(cache = True)
+def _group_walk(group, pos, mass, is_target, order, child, leaf, start, end, width, cm, M, Q, multipole, theta, acc):
+    """
+    Walk the tree once for the leaf 'group', building an interaction list that is shared by all the target
+    bodies of the leaf: positions and masses of the accepted nodes and of the single bodies, copied in
+    contiguous arrays, plus the accepted nodes for the quadrupole terms. A node is accepted if
+    width / d <= theta for the minimum distance d between its center of mass and the bounding box of the leaf.
+    """
+    stack = np.empty(STACK, dtype = np.int64)
+    sx, sy, sm = np.empty(256), np.empty(256), np.empty(256)
+    nodes = np.empty(256, dtype = np.int64)
+
+    # Bounding box of the bodies of the leaf
+    xmin, ymin, xmax, ymax = np.inf, np.inf, -np.inf, -np.inf
+    for k in range(start[group], end[group]):
+        i = order[k]
+        xmin, xmax = min(xmin, pos[i, 0]), max(xmax, pos[i, 0])
+        ymin, ymax = min(ymin, pos[i, 1]), max(ymax, pos[i, 1])
+
+    # Interaction list
+    n_src, n_nodes = 0, 0
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if M[node] == 0:
+            continue
+        if end[node] - start[node] > 1 and not leaf[node]:
+            dx = max(xmin - cm[node, 0], 0.0, cm[node, 0] - xmax)
+            dy = max(ymin - cm[node, 1], 0.0, cm[node, 1] - ymax)
+            if width[node] <= theta * np.sqrt(dx**2 + dy**2):
+                if n_src == len(sm):
+                    sx, sy, sm = _grow(sx, 2 * n_src), _grow(sy, 2 * n_src), _grow(sm, 2 * n_src)
+                sx[n_src], sy[n_src], sm[n_src] = cm[node, 0], cm[node, 1], M[node]
+                n_src += 1
+                if multipole > 1:
+                    if n_nodes == len(nodes):
+                        nodes = _grow(nodes, 2 * n_nodes)
+                    nodes[n_nodes] = node
+                    n_nodes += 1
+            else:
+                for q in range(4):
+                    if child[node, q] >= 0:
+                        stack[top] = child[node, q]
+                        top += 1
+        else:
+            for kk in range(start[node], end[node]):
+                j = order[kk]
+                if n_src == len(sm):
+                    sx, sy, sm = _grow(sx, 2 * n_src), _grow(sy, 2 * n_src), _grow(sm, 2 * n_src)
+                sx[n_src], sy[n_src], sm[n_src] = pos[j, 0], pos[j, 1], mass[j]
+                n_src += 1
+
+    # Evaluate the list for every target of the leaf. The body itself is in the list, but being at
+    # zero distance its softened force vanishes.
+    for k in range(start[group], end[group]):
+        i = order[k]
+        if not is_target[i]:
+            continue
+        x, y = pos[i, 0], pos[i, 1]
+        aX, aY = _sum_sources(x, y, sx, sy, sm, n_src)
+        for n in range(n_nodes):
+            node = nodes[n]
+            ax, ay = _QuadAcceleration(x, y, cm[node, 0], cm[node, 1], Q[node])
+            aX += ax
+            aY += ay
+        acc[i, 0] = aX
+        acc[i, 1] = aY
+
+@njit(fastmath = True, cache = True)
+def _sum_sources(x, y, sx, sy, sm, n):
+    """
+    Softened acceleration in (x, y) due to the first 'n' point masses of the list, in a vectorizable loop.
+    """
+    aX, aY = 0.0, 0.0
+    for j in range(n):
+        dx, dy = sx[j] - x, sy[j] - y
+        r2 = dx * dx + dy * dy + a2
+        f  = G * sm[j] / (r2 * np.sqrt(r2))
+        aX += f * dx
+        aY += f * dy
+    return aX, aY
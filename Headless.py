@@ -0,0 +1,150 @@
+import argparse
+import json
+import math
+import time
+
+from Diagnostics import Diagnostics
+from InitialCond import Compute_IC, CACHE_DIR
+from Profiler import Profiler
+from Simulation import Simulation
+
+
+def parse_args(argv = None):
+    """
+    Command line arguments of the headless driver. Values in the '--config' JSON file are used as defaults
+    and are overridden by the arguments given explicitly.
+    """
+    parser = argparse.ArgumentParser(description = 'Run the Barnes-Hut simulation without any display.')
+    parser.add_argument('--config', help = 'JSON file with the settings (keys as the long option names, with _)')
+    parser.add_argument('-N', type = int, default = 1000, help = 'number of bodies')
+    parser.add_argument('--seed', type = int, default = 10000, help = 'seed of the initial conditions')
+    parser.add_argument('--ic-cache', default = CACHE_DIR,
+                        help = 'directory of the cached initial conditions, "" to disable the cache')
+    parser.add_argument('--load', help = 'resume from a trajectory file instead of new initial conditions')
+    parser.add_argument('--load-step', type = int, default = None,
+                        help = 'step of the trajectory to resume from (default: the last one)')
+    parser.add_argument('--steps', type = int, default = 100, help = 'number of steps')
+    parser.add_argument('--t-end', type = float, default = None, help = 'end time, overrides --steps')
+    parser.add_argument('--dt', type = float, default = 1/20, help = 'time step')
+    parser.add_argument('--theta', type = float, default = 0.8, help = 'opening angle')
+    parser.add_argument('--multipole', type = int, choices = (1, 2), default = 1,
+                        help = 'order of the far field: 1 monopole, 2 quadrupole')
+    parser.add_argument('--leaf-size', type = int, default = 1,
+                        help = 'maximum bodies in a leaf, > 1 walks the tree once per leaf')
+    parser.add_argument('--engine', choices = ('bh', 'fmm', 'direct', 'auto'), default = 'bh',
+                        help = 'Barnes-Hut walk, Fast Multipole Method, direct sum, or direct sum for small N')
+    parser.add_argument('--order', type = int, default = 4, help = 'degree of the FMM expansions')
+    parser.add_argument('--direct-max-n', type = int, default = None,
+                        help = 'largest number of bodies summed directly by the engine auto (default: '
+                               'Gravity.DIRECT_MAX_N, tuned on one core)')
+    parser.add_argument('--fmm-theta', type = float, default = 0.4,
+                        help = 'separation criterion of the FMM node pairs, smaller than --theta for the same accuracy')
+    parser.add_argument('--precision', choices = ('float64', 'float32'), default = 'float64',
+                        help = 'precision of the positions, masses and node moments read by the tree walk')
+    parser.add_argument('--workers', type = int, default = None, help = 'threads for the forces (default: all)')
+    parser.add_argument('--rebuild-every', type = int, default = 10, help = 'maximum steps between tree builds')
+    parser.add_argument('--max-crossed', type = float, default = 1.0,
+                        help = 'rebuild the tree instead of refitting it if more than this fraction of the bodies '
+                               'left their leaf')
+    parser.add_argument('--max-leaf', type = int, default = None,
+                        help = 'rebuild the tree instead of refitting it if a leaf gets more bodies than this '
+                               '(default: twice --leaf-size, at least 8)')
+    parser.add_argument('--integrator', choices = ('verlet', 'kdk'), default = 'verlet',
+                        help = 'global-step Störmer–Verlet or kick-drift-kick leapfrog with block time steps')
+    parser.add_argument('--eta', type = float, default = 0.1,
+                        help = 'accuracy parameter of the block time steps: smaller is more accurate but puts more '
+                               'bodies on short steps: 0.1 takes about 2.6 force evaluations per body and step, '
+                               '0.025 about 5, more than Verlet with dt / 4')
+    parser.add_argument('--max-level', type = int, default = 6, help = 'smallest block time step is dt / 2**max_level')
+    parser.add_argument('--compact-every', type = int, default = 100,
+                        help = 'steps between two removals of the escaped bodies, 0 to keep them')
+    parser.add_argument('--escape-radius', type = float, default = None,
+                        help = 'remove the bodies farther than this from the center of mass')
+    parser.add_argument('--merge-radius', type = float, default = None,
+                        help = 'merge the bodies closer than this, conserving mass and momentum (default: off)')
+    parser.add_argument('--every', type = int, default = 10, help = 'output cadence, in steps')
+    parser.add_argument('--diagnostics', help = 'write energy, momentum and virial ratio to this .csv or .jsonl file')
+    parser.add_argument('--diag-every', type = int, default = None,
+                        help = 'steps between two diagnostics records (default: --every)')
+    parser.add_argument('--profile', action = 'store_true', help = 'time the phases of every step and print a summary')
+    parser.add_argument('--profile-log', default = None, help = 'JSON lines file with the timers of every step')
+    parser.add_argument('--profile-sample', type = float, default = 0,
+                        help = 'seconds between two samples of the sampling profiler (default: off)')
+    parser.add_argument('--count-every', type = int, default = 10,
+                        help = 'steps between two counts of the tree walk interactions when profiling')
+    parser.add_argument('--save', help = 'write the trajectory to the file SAVE')
+    parser.add_argument('--save-every', type = int, default = None,
+                        help = 'steps between two blocks of the trajectory (default: --every)')
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config is not None:
+        with open(args.config) as handle:
+            parser.set_defaults(**json.load(handle))
+    return parser.parse_args(argv)
+
+def run(args):
+    """
+    Run the simulation described by 'args' and return the Simulation() object.
+    """
+    profiler = Profiler(args.profile_log, args.profile or args.profile_log is not None, args.profile_sample,
+                        args.count_every)
+    settings = dict(dt = args.dt, theta = args.theta, multipole = args.multipole, leaf_size = args.leaf_size,
+                    profiler = profiler, engine = args.engine, order = args.order, fmm_theta = args.fmm_theta,
+                    direct_max_n = args.direct_max_n, workers = args.workers, rebuild_every = args.rebuild_every,
+                    max_crossed = args.max_crossed, max_leaf = args.max_leaf, integrator = args.integrator,
+                    eta = args.eta, max_level = args.max_level,
+                    compact_every = args.compact_every, escape_radius = args.escape_radius,
+                    merge_radius = args.merge_radius, precision = args.precision)
+    if args.load is not None:
+        sim = Simulation.from_snapshot(args.load, args.load_step, **settings)
+    else:
+        print(f'Computing initial conditions for {args.N} particles')
+        sim = Simulation(Compute_IC(args.N, seed = args.seed, cache = args.ic_cache or None), **settings)
+
+    steps = args.steps if args.t_end is None else math.ceil(args.t_end / args.dt)
+    save_every = args.every if args.save_every is None else args.save_every
+    writer = None
+    if args.save is not None:
+        print(f'Writing the trajectory to {args.save}')
+        writer = sim.writer(args.save)
+        sim.save(writer)
+
+    diagnostics = None
+    if args.diagnostics is not None:
+        diagnostics = Diagnostics(args.diagnostics, args.every if args.diag_every is None else args.diag_every)
+        diagnostics.record(sim, force = True)
+
+    t0 = time.time()
+    for n in range(1, steps + 1):
+        sim.step()
+        if diagnostics is not None:
+            with profiler.timer('diagnostics'):
+                diagnostics.record(sim, force = n == steps)
+        if n % args.every == 0 or n == steps:
+            wall = time.time() - t0
+            drift = f'   dE/E = {diagnostics.rows[-1]["dE"]:+.3e}' if diagnostics is not None else ''
+            print(f'step {sim.n_step:>7}   t = {sim.t:10.4f}   wall = {wall:9.3f} s   '
+                  f'{wall / n:.4f} s/step{drift}', flush = True)
+        if writer is not None and (n % save_every == 0 or n == steps):
+            with profiler.timer('save'):
+                sim.save(writer)
+        profiler.end_step(sim.n_step)
+    if sim.currentEngine() != 'direct':
+        print(sim.updateTree().stats())
+    print(f'Removed bodies: {sim.n_removed} ({sim.n_escaped} escaped), {sim.fused} mergers')
+    print(f'Force evaluations: {sim.n_forces} ({sim.n_forces / max(1, steps * len(sim.particles)):.3f} per body per step)')
+    if args.integrator == 'kdk':
+        print(f'Block time step levels: {sim.level_counts.tolist()}')
+
+    if writer is not None:
+        writer.close()
+    if diagnostics is not None:
+        diagnostics.close()
+    profiler.close()
+    if profiler.enabled:
+        print(profiler.summary())
+    return sim
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -1,34 +1,45 @@
+import os
 import numpy as np
 
 from numba import njit, vectorize
-from Sampler  import run_sampler
-from Particle import Particle
+from Sampler  import sample_velocity_ratio
+from Particle import ParticleSet
 
 from PyGFun import to_pg, from_pg, WIDTH, HEIGHT
 global WIDTH, HEIGHT
 
-@vectorize
+global CACHE_DIR, VERSION
+CACHE_DIR = 'ic_cache'            # Directory of the cached initial conditions, see Compute_IC()
+VERSION   = 2                     # Version of the generator, part of the name of the cached files
+
+@vectorize(cache = True)
 def Ve(r):
     return np.sqrt(2) * ( 1 + r**2)**(-1/4)
 
-def Compute_IC(N_0, seed = None):
+def Compute_IC(N_0, seed = None, R = 100, Mtot = 100, cache = CACHE_DIR):
+    """
+    Plummer sphere of 'N_0' bodies with scale 'R' and total mass 'Mtot', generated with arrays only.
+    With a 'seed', the initial conditions are cached in the directory 'cache' (None to disable it), keyed by
+    N_0, seed, R, Mtot and the version of the generator, so that the same call is read back from disk.
+    """
+    path = None
+    if seed != None and cache != None:
+        path = os.path.join(cache, f'plummer_N{N_0}_seed{seed}_R{R:g}_M{Mtot:g}_v{VERSION}.npz')
+        if os.path.exists(path):
+            with np.load(path) as data:
+                return ParticleSet(data['pos'], data['vel'], data['mass'], _color = (255,255,255),
+                                   _tolen = float(data['to_len']))
     
-    if seed != None:
-        np.random.seed(seed)
-        samples = run_sampler(0.5, 2*N_0+1000, 1000, 0.1, seed)
-    else:
-        samples = run_sampler(0.5, 2*N_0+1000, 1000, 0.1)
+    rng = np.random.default_rng(seed)
     
-    R = 100
-    Mtot = 100
     Energy = -(3 * np.pi / 64) * Mtot**2 / R
     
     to_len = 3 * np.pi * Mtot**2 / ( 64 * np.abs(Energy)) 
     to_vel = 64 * np.sqrt(np.abs(Energy) / Mtot) / (3 * np.pi)
     
-    masses = np.random.uniform(size = N_0)
+    masses = rng.uniform(size = N_0)
     radius = ( masses**(-2/3) - 1 )**(-1/2)
-    angs = np.random.uniform(size = N_0)
+    angs = rng.uniform(size = N_0)
     
     x      = np.sqrt( radius ) * np.cos(2*np.pi* angs)
     y      = np.sqrt( radius ) * np.sin(2*np.pi* angs)
@@ -36,20 +47,24 @@ def Compute_IC(N_0, seed = None):
     #x[:len(x)//2] = x[:len(x)//2] + 5
     #x[len(x)//2:] = x[len(x)//2:] - 5
     
-    V = samples[:N_0] * Ve(radius)
-    angs = np.random.uniform(size = N_0) 
+    V = sample_velocity_ratio(N_0, rng) * Ve(radius)
+    angs = rng.uniform(size = N_0) 
     vx      = np.sqrt( V ) * np.cos(2*np.pi* angs)
     vy      = np.sqrt( V ) * np.sin(2*np.pi* angs)
     
-    particles = []
-    for i in range(N_0):
-        pos = to_pg( (x[i] *to_len, y[i] *to_len) )
-        v   = [vx[i]*to_vel, vy[i]*to_vel]
-        particles.append(Particle(pos, v, masses[i]*Mtot, _color = (255,255,255), _tolen = to_len))
+    pos = np.stack((x * to_len, y * to_len), axis = 1)
+    vel = np.stack((vx * to_vel, vy * to_vel), axis = 1)
+    particles = ParticleSet(pos, vel, masses * Mtot, _color = (255,255,255), _tolen = to_len)
+    
+    if path != None:
+        # Write to a temporary file and rename it, so that concurrent runs never read a partial file
+        os.makedirs(cache, exist_ok = True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, pos = particles.pos, vel = particles.vel, mass = particles.mass, to_len = to_len)
+        os.replace(tmp, path)
     
     ### TEST CONFIGURATION
-    #particles = []
-    #particles.append(Particle( to_pg((0,0)), [0,0], 100, _color = (255,255,255), _tolen = 1))
-    #particles.append(Particle( to_pg((100,0)), [0,-.5], 100, _color = (255,255,255), _tolen = 1))
+    #particles = ParticleSet([(0,0), (100,0)], [[0,0], [0,-.5]], [100, 100], _color = (255,255,255), _tolen = 1)
     
-    return particles
\ No newline at end of file
+    return particles
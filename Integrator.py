@@ -0,0 +1,63 @@
+import numpy as np
+from numba import njit
+
+from Gravity import a2
+
+
+def BlockLevels(acc, dt, eta, max_level):
+    """
+    Power-of-two time step level of every body: the step of level l is dt / 2**l, the smallest one not larger
+    than sqrt(2 eta eps / |a|), eps = sqrt(a2) being the softening length.
+    """
+    return _levels(acc, dt, eta, np.sqrt(a2), max_level)
+
+
+@njit(cache = True)
+def _levels(acc, dt, eta, eps, max_level):
+    levels = np.zeros(acc.shape[0], dtype = np.int64)
+    for i in range(acc.shape[0]):
+        a = np.sqrt(acc[i, 0]**2 + acc[i, 1]**2)
+        if a == 0:
+            continue
+        dt_i = np.sqrt(2 * eta * eps / a)
+        l = 0
+        while l < max_level and dt / 2**l > dt_i:
+            l += 1
+        levels[i] = l
+    return levels
+
+@njit(cache = True)
+def _kick(vel, acc, idx, levels, dt):
+    """
+    Half kick of the bodies 'idx', each one with its own step dt / 2**level.
+    """
+    for k in range(len(idx)):
+        i = idx[k]
+        h = 0.5 * dt / 2**levels[i]
+        vel[i, 0] += acc[i, 0] * h
+        vel[i, 1] += acc[i, 1] * h
+
+@njit(cache = True)
+def _drift(pos, vel, skip, still, dt):
+    """
+    Drift of all the movable bodies by 'dt'.
+    """
+    for i in range(pos.shape[0]):
+        if skip[i] or still[i]:
+            continue
+        pos[i, 0] += vel[i, 0] * dt
+        pos[i, 1] += vel[i, 1] * dt
+
+@njit(cache = True)
+def _resync(levels, new_levels, idx, tick, max_level):
+    """
+    Assign the new levels to the bodies 'idx' that start a step at 'tick' (in units of dt / 2**max_level).
+    A body can move to a larger step only if 'tick' is a multiple of it, so that all the bodies are
+    synchronized again at the end of the step.
+    """
+    for k in range(len(idx)):
+        i = idx[k]
+        l = new_levels[i]
+        while tick % (1 << (max_level - l)) != 0:
+            l += 1
+        levels[i] = l
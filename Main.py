@@ -2,10 +2,7 @@ import os
 import sys
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 
-import pygame as pg
-import pickle
-
-from NBody import mainLoop
+from Snapshot import Trajectory
 from InitialCond import Compute_IC
 from PyGFun import WIDTH, HEIGHT
 
@@ -13,17 +10,6 @@ global WIDTH, HEIGHT
 
 
 
-def Save(tree, N_0, name):
-    # Store data (serialize)
-    with open(f'{name}.pickle', 'wb') as handle:
-        pickle.dump(tree, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        
-def Load(path):
-    # Load data (deserialize)
-    with open(path, 'rb') as handle:
-        return pickle.load(handle)
-
-
 if __name__ == '__main__':
     
     inp = input('Insert 1 to execute a new simulation, 2 to load a previous one: ')
@@ -47,28 +33,25 @@ if __name__ == '__main__':
             sys.exit(1)
 
     list_of_savefile = []
-    list_of_gif      = []
     if load:
         folders = os.listdir('.')
         for folder in folders:
-            if '.pickle' in folder:
+            if '.nbody' in folder:
                 list_of_savefile.append(folder)
-            elif '.gif' in folder:
-                list_of_gif.append(folder)
         if len(list_of_savefile) == 0:
-            print('No .pickle found in this path.')
+            print('No .nbody found in this path.')
         else:
-            print('These are the .pickle files found:')
+            print('These are the .nbody files found:')
             print(list_of_savefile)
         path = input(f'Insert path to save file: ')
         if os.path.isfile(path):
             print('Save file found. Retrieving data...')
-            old_tree = Load(path)
+            N_0 = Trajectory(path).N_0
         else:
             print('File not found. Abort.')
             sys.exit(1)
     
-    svFIN = input('Save final state? (Y/N) ')
+    svFIN = input('Save trajectory? (Y/N) ')
     FIN = False
     if svFIN == 'Y' or svFIN == 'y' or svFIN == 'yes' or svFIN == 'Yes': 
         FIN = True
@@ -100,41 +83,41 @@ if __name__ == '__main__':
     ###          MAIN LOOP
     #####################################################################################################
     
+    output = None
+    if FIN:
+        name = f'savefile_N{N_0}_'
+        nnn = 0
+        for svfN in os.listdir('.'):
+            if name in svfN:
+                nnn += 1
+        output = name + f'{nnn}.nbody'
+        print(f"Writing the trajectory to {output}")
+
+    video = None
+    if GIF:
+        name = f'simulation_N0{N_0}_'
+        nnn = 0
+        for gifN in os.listdir('.'):
+            if name in gifN:
+                nnn += 1
+        video = name + f'{nnn}.gif'
+        print(f'Recording {video}')
+
+    # pygame and the display loop are imported only once the window is needed
+    import pygame as pg
+    from NBody import mainLoop
+
     pg.init()    
     WIN = pg.display.set_mode((WIDTH+400, HEIGHT))
     pg.display.set_caption("B-H Simulation")
     
     if load:
-        tree = mainLoop(WIN, particles = None, N_0 = old_tree.N_0, old_tree = old_tree, gif = GIF)
+        tree = mainLoop(WIN, particles = None, N_0 = N_0, snapshot = path, video = video, output = output,
+                        engine = 'auto')
     else:
-        tree = mainLoop(WIN, particles, N_0, gif = GIF)
+        tree = mainLoop(WIN, particles, N_0, video = video, output = output, engine = 'auto')
   
     pg.quit()
     
     
-#####################################################################################################
-###          SAVE
-#####################################################################################################
-    
-    if FIN:
-        name = f'savefile_N{tree.N_0}_'
-        nnn = 0
-        for svfN in list_of_savefile:
-            if name in svfN:
-                nnn += 1
-        name += f'{nnn}'
-        print(f"Saving final state to savefile_N{tree.N_0}.pickle")
-        Save(tree, tree.N_0, name)
-    
-    if GIF:
-        name = f'simulation_N0{tree.N_0}_'
-        nnn = 0
-        for gifN in list_of_gif:
-            if name in gifN:
-                nnn += 1
-        name += f'{nnn}'
-        
-        print(f'Generating {name}.gif')
-        os.system(f'ffmpeg -r 60 -f image2 -s {WIDTH+400}x{HEIGHT} -i output/screen_%05d.png {name}.gif -y > /dev/null')
-        os.system('rm output/*.png')
     print('Done.')
@@ -1,133 +1,211 @@
 import numpy as np
 import pygame as pg
 import time
-import matplotlib.backends.backend_agg as agg
-import matplotlib.pyplot as plt
 
-from pygame.locals import *
-from numba import njit
-
-from QuadTree import Tree, Quad
-from Particle import Particle, DrawAllParticles
+from Profiler import Profiler
+from Render import Renderer
+from VideoSink import VideoSink
+from Worker import PhysicsWorker
 from PyGFun import check_Event_Logic, to_pg, from_pg, WIDTH, HEIGHT
 
 global WIDTH, HEIGHT
 
-from collections import Iterable
-def flatten(lis):
-    for item in lis:
-        if isinstance(item, Iterable) and not isinstance(item, str):
-            for x in flatten(item):
-                yield x
-        else:        
-            yield item
-
-def radial_dist(quad):
-    r = []
-    if len(quad.particlesINquad) == 1:
-        xx, yy = from_pg( ( quad.particlesINquad[-1].x, quad.particlesINquad[-1].y) )
-        r.append(np.sqrt(xx**2 + yy**2))
-    elif len(quad.particlesINquad) > 1:
-        for key in quad.keys:
-            r.append(radial_dist(quad.children[key]))
-    return r
-
-def R_hist(tree):
-    r = radial_dist(tree.RootQuad)
-    r = list(flatten(r))
-    fig = plt.figure(figsize=[4, 4], # Inches
-               dpi=100,        # 100 dots per inch, so the resulting buffer is 400x400 pixels
-               )
-    ax = fig.gca()
-    ax.hist(r, bins = 100, histtype = 'step', color = 'r')
-    ax.set_title('Histogram of radial positions')
-    ax.set_xlabel('Radius')
-    
-    canvas = agg.FigureCanvasAgg(fig)
-    canvas.draw()
-    renderer = canvas.get_renderer()
-    raw_data = renderer.tostring_rgb()
-    return canvas, raw_data, fig
+def radial_dist(pos):
+    return np.sqrt(pos[:, 0]**2 + pos[:, 1]**2)
+
+class RadialPanel():
+    """
+    Histogram of the radial positions drawn on a persistent 400x400 pygame surface. The bins have fixed edges
+    between 0 and 'r_max' and the histogram is recomputed at most every 'refresh' seconds, in between
+    draw() just blits the last surface.
+    """
+
+    def __init__(self, size = (400, 400), bins = 100, r_max = WIDTH / 2, refresh = 0.25, color = (255, 0, 0)):
+        self.size    = size
+        self.bins    = bins
+        self.r_max   = r_max
+        self.refresh = refresh
+        self.color   = color
+        self.counts  = np.zeros(bins, dtype = np.int64)
+        self.surface = pg.Surface(size)
+        self.font    = pg.font.Font(None, 18)
+        self._last   = -np.inf
+        # Plot area inside the surface
+        self.box = pg.Rect(45, 30, size[0] - 60, size[1] - 75)
 
-def Update_display(SURF, tree, show_tree, fig, canvas, raw_data):
+    def update(self, pos, now = None):
+        """
+        Bin the radii of the bodies at 'pos' and redraw the surface, if 'refresh' seconds went by since the last
+        update. Bodies beyond 'r_max' are not counted.
+        """
+        now = time.time() if now is None else now
+        if now - self._last < self.refresh:
+            return False
+        self._last = now
+        r = radial_dist(pos)
+        k = (r * (self.bins / self.r_max)).astype(np.int64)
+        self.counts = np.bincount(k[k < self.bins], minlength = self.bins)
+        self._redraw()
+        return True
+
+    def _redraw(self):
+        S, box, font = self.surface, self.box, self.font
+        S.fill((255, 255, 255))
+        top = max(1, int(self.counts.max()))
+
+        # Step line of the histogram
+        x = box.left + np.arange(self.bins + 1) * box.width / self.bins
+        y = box.bottom - self.counts * box.height / top
+        points = np.empty((2 * self.bins, 2))
+        points[0::2, 0], points[1::2, 0] = x[:-1], x[1:]
+        points[0::2, 1] = points[1::2, 1] = y
+        pg.draw.lines(S, self.color, False, points.tolist())
+
+        # Axes, ticks and labels
+        black = (0, 0, 0)
+        pg.draw.rect(S, black, box, width = 1)
+        for frac in (0, 0.5, 1):
+            xt = box.left + frac * box.width
+            pg.draw.line(S, black, (xt, box.bottom), (xt, box.bottom + 4))
+            label = font.render(f'{frac * self.r_max:g}', True, black)
+            S.blit(label, label.get_rect(midtop = (xt, box.bottom + 6)))
+            yt = box.bottom - frac * box.height
+            pg.draw.line(S, black, (box.left - 4, yt), (box.left, yt))
+            label = font.render(f'{frac * top:g}', True, black)
+            S.blit(label, label.get_rect(midright = (box.left - 6, yt)))
+        title = font.render('Histogram of radial positions', True, black)
+        S.blit(title, title.get_rect(midtop = (self.size[0] / 2, 8)))
+        xlabel = font.render('Radius', True, black)
+        S.blit(xlabel, xlabel.get_rect(midbottom = (box.centerx, self.size[1] - 6)))
+
+    def draw(self, SURF, topleft = (WIDTH, 0)):
+        SURF.blit(self.surface, topleft)
+
+def DrawFrame(SURF, frame, show_tree, renderer):
+    """
+    Draw a state published by the physics worker, see Worker.SharedState.read(), with a Render.Renderer().
+    """
     # If the button "t" is pressed, show the tree
-    if show_tree: tree.draw(SURF)
-    # Show histogram
-    size = canvas.get_width_height()
-    sur = pg.image.fromstring(raw_data, size, "RGB")
-    SURF.blit(sur, (WIDTH,0))
-    # Draw particles
-    DrawAllParticles(tree, SURF)
-    # update display
-    pg.display.update()
-    # Close figure to avoid cluttering
-    plt.close(fig)
-        
-def mainLoop(WIN, particles, N_0, old_tree = None, gif = False):
+    boxes = frame['boxes'] if show_tree else None
+    renderer.draw(SURF, frame['pos'], frame['skip'], frame['color'], frame['mass'], boxes)
+
+def mainLoop(WIN, particles, N_0, snapshot = None, video = None, workers = None, rebuild_every = 10,
+             max_crossed = 1.0, max_leaf = None, integrator = 'verlet', multipole = 1,
+             leaf_size = 1, engine = 'bh', order = 4, fmm_theta = 0.4, direct_max_n = None, output = None, save_every = 10,
+             refresh = 0.25, render = 'color', diagnostics = None, diag_every = 10, profile = False,
+             profile_log = None, merge_radius = None, precision = 'float64'):
     """
-    Main animation loop of pygame.
-            - particles: list of Particle() objects, initial condition
-            - N_0      : len(particles)
+    Main animation loop of pygame. The physics runs in a PhysicsWorker() process and the window shows the
+    latest step it published, at most 60 times per second: 't' and the space bar are sent to it as commands.
+            - particles    : ParticleSet(), initial condition
+            - N_0          : len(particles)
+            - snapshot     : trajectory file to resume from (its last step), instead of 'particles'
+            - output       : trajectory file written every 'save_every' steps, and at the end
+            - video        : .gif or .mp4 file recording the window, see VideoSink()
+            - refresh      : seconds between two updates of the radial histogram, see RadialPanel()
+            - render       : 'color', 'mass' or 'density', see Render.Renderer()
+            - diagnostics  : .csv or .jsonl file with energy, momenta and virial ratio every 'diag_every' steps
+            - profile      : time the phases of the frames and of the physics steps, see Profiler(); with
+                             'profile_log' the timers go to profile_log.display.jsonl and profile_log.physics.jsonl
+            - workers      : number of threads used for the forces, all the cores if None
+            - rebuild_every: maximum number of steps between two full builds of the tree, in between
+                             the tree is refitted (see Tree.update() for 'max_crossed' and 'max_leaf')
+            - integrator   : 'verlet' or 'kdk' (block time steps), see Simulation()
+            - multipole    : 1 for monopoles only, 2 to add the quadrupoles of the nodes
+            - leaf_size    : maximum bodies in a leaf of the tree, > 1 to walk the tree once per leaf
+            - engine, order: 'bh' for the Barnes-Hut walk, 'fmm' for the Fast Multipole Method with expansions of
+                             degree 'order', 'direct' for the direct sum, 'auto' for the direct sum up to
+                             'direct_max_n' bodies (Gravity.DIRECT_MAX_N if None) and the Barnes-Hut walk above
+            - fmm_theta    : separation criterion of the node pairs of the FMM, see FMM.FMMForces()
+            - merge_radius : bodies closer than this merge, see Simulation.merge(); None for no mergers
+            - precision    : 'float32' for a single precision tree walk, see Tree.store()
     """
     run = True
     show_tree = False
+    paused = False
     clock = pg.time.Clock()
-    
-    D = WIDTH
+
+    settings = dict(workers = workers, rebuild_every = rebuild_every, max_crossed = max_crossed, max_leaf = max_leaf,
+                    integrator = integrator, multipole = multipole, leaf_size = leaf_size,
+                    engine = engine, order = order, fmm_theta = fmm_theta, direct_max_n = direct_max_n,
+                    merge_radius = merge_radius, precision = precision)
+    if snapshot != None:
+        from Snapshot import Trajectory
+        r = Trajectory(snapshot).meta['r']
+    else:
+        settings['N_0'] = N_0
+        r = particles.r
+    profile = profile or profile_log != None
+    worker = PhysicsWorker(particles, snapshot, settings, output, save_every, diagnostics = diagnostics,
+                           diag_every = diag_every, profile = profile,
+                           profile_log = None if profile_log == None else f'{profile_log}.physics.jsonl')
+    profiler = Profiler(None if profile_log == None else f'{profile_log}.display.jsonl', profile)
+
+    panel = RadialPanel(refresh = refresh)
+    renderer = Renderer(render, r)
+
+    sink = None
+    if video != None:
+        sink = VideoSink(video, WIN.get_size())
 
     t = 0
     N_frame = 0
-    N_fuse = 0
+    last_step = -1
     
     while run:
+        with profiler.timer('wait'):
+            clock.tick(60)
         t1 = time.time()
-        clock.tick(60)
-        WIN.fill((0, 0, 26))
         
-        if old_tree == None:
-            # Compute the Tree starting from the outer Root quad
-            OuterQuad = Quad(to_pg((0,0)), D, particles)       # Define outer quad
-            tree = Tree(OuterQuad)                             # Define tree object
-            tree.createTree()                     # Create the tree checking for collisions
-        else:
-            tree = old_tree
-            N_fuse = old_tree.fused
-            particles = old_tree.find_particles(old_tree.RootQuad)
-            old_tree = None
+        # Latest complete step published by the physics
+        with profiler.timer('read'):
+            frame = worker.read()
+        if not worker.alive:
+            break
             
-        # Compute histogram of radial distances
-        canvas, raw_data, fig = R_hist(tree)
+        # Histogram of radial distances, refreshed every 'refresh' seconds
+        with profiler.timer('histogram'):
+            panel.update(frame['pos'][~frame['skip']])
         
-        # Check if some button has been pressed
-        show_tree, run = check_Event_Logic(run, show_tree, tree, WIN)
+        # Check if some button has been pressed and forward it to the physics
+        with profiler.timer('events'):
+            new_tree, run, new_paused = check_Event_Logic(run, show_tree, paused)
+            if new_tree != show_tree:
+                worker.send('tree' if new_tree else 'notree')
+            if new_paused != paused:
+                worker.send('pause' if new_paused else 'resume')
+            show_tree, paused = new_tree, new_paused
         
-        # Update display
-        Update_display(WIN, tree, show_tree, fig, canvas, raw_data)
+        # Draw tree, particles and histogram
+        with profiler.timer('render'):
+            WIN.fill((0, 0, 26))
+            DrawFrame(WIN, frame, show_tree, renderer)
+            panel.draw(WIN)
+        with profiler.timer('display'):
+            pg.display.update()
         
-        # Compute serially the forces
-        for particle in particles:
-            if particle.skip == False:
-                particle.computeForce(tree)
-
-        # Move all the particles
-        for particle in particles:
-            particle.move(tree)
+        if sink != None and frame['step'] != last_step:
+            with profiler.timer('video'):
+                sink.write(WIN)
+        last_step = frame['step']
         
         t2 = time.time()
-        sss = f"Time between frames: {t2 - t1} s"
+        sss = f"Time between frames: {t2 - t1} s   step {frame['step']}"
         print ("\r" + sss, end='')
         
         t += t2 - t1
-        
-        if gif:
-            filename = "output/screen_%05d.png" % ( N_frame )
-            pg.image.save( WIN, filename )
-        
+        profiler.end_step(N_frame)
         N_frame += 1
     
     print()
-    print(f'Mean time between frames: {t/N_frame} s')    
-    tree.fused = N_fuse
-    tree.N_0 = N_0
-    
-    return tree
\ No newline at end of file
+    print(f'Mean time between frames: {t/max(1, N_frame)} s')
+    particles, report = worker.quit()
+    print(report)
+    if sink != None:
+        print(f'Encoding {video}')
+        sink.close()
+    profiler.close()
+    if profile:
+        print(profiler.summary('Display profile'))
+
+    return particles
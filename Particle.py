@@ -1,151 +1,265 @@
 import numpy as np
-import pygame as pg
 from numba import njit
 
+from Gravity import G, a2, TreeForces, _Acceleration
 from PyGFun import to_pg, from_pg, WIDTH, HEIGHT
 global WIDTH, HEIGHT
 
-global G, a2
-G  = 1
-a2 = 0.001
-
-class Particle():
+class ParticleSet():
+    """
+    Structure-of-arrays storage of all the bodies of the simulation.
+    Positions are stored in simulation coordinates (origin in the center of the domain), not in pygame coordinates.
+            - pos, pos_old : (N, 2) arrays, current and previous positions
+            - vel, acc     : (N, 2) arrays, velocities and accelerations
+            - mass         : (N,) array
+            - ids          : (N,) array, index of every body in the initial conditions
+            - skip, first, still : (N,) boolean flags
+            - color        : (N, 3) array of RGB colors
+    """
 
     def __init__(self, _pos, _vel, _mass, _r = 2, _color = None, _tolen = None):
-        self.x = _pos[0]
-        self.y = _pos[1]
-        self.x_old, self.y_old = from_pg( (_pos[0], _pos[1]) )
-        
-        self.aX = 0
-        self.aY = 0
-        
-        self.vx = _vel[0]
-        self.vy = _vel[1]
-        
-        self.mass = _mass
-
-        self.skip = False
-        self.first = True
-        self.still = False
-        
-        self.r     = _r
-        if _color == None:
+        self.pos     = np.array(_pos, dtype = np.float64).reshape(-1, 2)
+        self.pos_old = self.pos.copy()
+        self.vel     = np.array(_vel, dtype = np.float64).reshape(-1, 2)
+        self.acc     = np.zeros_like(self.pos)
+        self.mass    = np.array(_mass, dtype = np.float64).reshape(-1)
+
+        N = len(self.mass)
+        self.ids   = np.arange(N, dtype = np.int64)
+        self.skip  = np.zeros(N, dtype = np.bool_)
+        self.first = np.ones(N, dtype = np.bool_)
+        self.still = np.zeros(N, dtype = np.bool_)
+
+        self.r = _r
+        if _color is None:
             self.color = self.color_mapp()
         else:
-            self.color = _color
+            self.color = np.array(np.broadcast_to(_color, (N, 3)), dtype = np.float64)
         self.to_len = _tolen
-            
+
+    @classmethod
+    def from_particles(cls, particles):
+        """
+        Collect a list of Particle() objects into a single ParticleSet().
+        """
+        sets = [p._set[[p._i]] for p in particles]
+        out  = cls(np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0), _color = np.zeros((0, 3)))
+        for name in cls._arrays:
+            setattr(out, name, np.concatenate([getattr(s, name) for s in sets]))
+        out.r, out.to_len = sets[0].r, sets[0].to_len
+        return out
+
+    _arrays = ('pos', 'pos_old', 'vel', 'acc', 'mass', 'ids', 'skip', 'first', 'still', 'color')
+
+    def __len__(self):
+        return len(self.mass)
+
+    def __getitem__(self, idx):
+        """
+        An integer returns a Particle() view on that body, anything else (slice, mask, index array) a new ParticleSet().
+        """
+        if isinstance(idx, (int, np.integer)):
+            return Particle.view(self, int(idx))
+        out = self.__class__.__new__(self.__class__)
+        for name in self._arrays:
+            setattr(out, name, getattr(self, name)[idx].copy())
+        out.r, out.to_len = self.r, self.to_len
+        return out
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Particle.view(self, i)
+
+    def color_mapp(self):
+        """
+        Return a shade of red based on the mass of the particles
+        """
+        out = np.zeros((len(self.mass), 3))
+        out[:, 0] = 25.5 * self.mass/np.sqrt(1 + self.mass**2/100)
+        return out
+
+    def computeForce(self, tree, workers = None):
+        """
+        Compute the accelerations of all the bodies that are not skipped with a single compiled walk of 'tree',
+        running on 'workers' threads (all the cores if None).
+        """
+        TreeForces(tree, self, workers = workers)
+
+    def move(self, tree = None, dt = None):
+        """
+        Advance all the bodies by one step of Störmer–Verlet, see Particle.move(). The step is 'dt', or the one
+        of 'tree' if None.
+        """
+        dt = tree.dt if dt is None else dt
+        _verlet_all(self.pos, self.pos_old, self.vel, self.acc, self.first, self.skip, self.still, dt)
+
+    def draw(self, SURF, idx = None, mode = 'color'):
+        """
+        Draws the particles in 'idx' (all of them if None) in a single pass, see Render.Renderer().
+        """
+        from Render import Renderer
+        if idx is None:
+            idx = np.arange(len(self))
+        Renderer(mode, self.r).draw(SURF, self.pos[idx], self.skip[idx], self.color[idx], self.mass[idx])
+
+
+def _field(name, col = None):
+    """
+    Property that reads and writes one entry of a ParticleSet() array.
+    """
+    if col is None:
+        def fget(self): return getattr(self._set, name)[self._i]
+        def fset(self, value): getattr(self._set, name)[self._i] = value
+    else:
+        def fget(self): return getattr(self._set, name)[self._i, col]
+        def fset(self, value): getattr(self._set, name)[self._i, col] = value
+    return property(fget, fset)
+
+
+class Particle():
+    """
+    Thin view on a single body of a ParticleSet(). Kept for compatibility with the per-object interface,
+    'x' and 'y' are in pygame coordinates while everything else is in simulation coordinates.
+    """
+
+    def __init__(self, _pos, _vel, _mass, _r = 2, _color = None, _tolen = None):
+        pos = from_pg( (_pos[0], _pos[1]) )
+        self._set = ParticleSet([pos], [_vel], [_mass], _r, _color, _tolen)
+        self._i   = 0
+
+    @classmethod
+    def view(cls, pset, i):
+        """
+        Return a Particle() that reads and writes the body 'i' of 'pset'.
+        """
+        self = cls.__new__(cls)
+        self._set = pset
+        self._i   = i
+        return self
+
+    def __eq__(self, other):
+        return isinstance(other, Particle) and self._set is other._set and self._i == other._i
+
+    x_old = _field('pos_old', 0)
+    y_old = _field('pos_old', 1)
+    vx    = _field('vel', 0)
+    vy    = _field('vel', 1)
+    aX    = _field('acc', 0)
+    aY    = _field('acc', 1)
+    mass  = _field('mass')
+    skip  = _field('skip')
+    first = _field('first')
+    still = _field('still')
+    color = _field('color')
+
+    @property
+    def x(self):
+        return self._set.pos[self._i, 0] + WIDTH / 2
+
+    @x.setter
+    def x(self, value):
+        self._set.pos[self._i, 0] = value - WIDTH / 2
+
+    @property
+    def y(self):
+        return self._set.pos[self._i, 1] + HEIGHT / 2
+
+    @y.setter
+    def y(self, value):
+        self._set.pos[self._i, 1] = value - HEIGHT / 2
+
+    @property
+    def r(self):
+        return self._set.r
+
+    @property
+    def to_len(self):
+        return self._set.to_len
+
     def color_mapp(self):
         """
         Return a shade of red based on the mass of the particle
         """
         return (25.5 * self.mass/np.sqrt(1 + self.mass**2/100), 0, 0)
-            
+
     def RelDist(self, other):
         """
         Compute the relative distance of 'self' and 'other'.
         'other' can be either a tuple containing the particle coordinates or a Particle() object
         """
-        xx, yy = from_pg( (self.x, self.y) )
+        xx, yy = self._set.pos[self._i]
         if type(other) is tuple:
             return _RelDist(xx, yy, other[0], other[1])
         else:
-            xxx, yyy = from_pg( (other.x, other.y) )
+            xxx, yyy = other._set.pos[other._i]
             return _RelDist(xx, yy, xxx, yyy)
-    
-    def checkCases(self, quad):
-        """
-        Check if the particles in a quad act as a single particle through thei center of mass or if the children need to be checked.
-        'quad' is a Quad() object.
-        """
-        if len(quad.particlesINquad) == 1:
-            if quad.particlesINquad[0] == self:   return                                       # Avoid computing forces on itself
-            selfx, selfy = from_pg( (self.x, self.y) )                                         
-            othx , othy  = from_pg( (quad.particlesINquad[0].x, quad.particlesINquad[0].y) )
-            aX, aY = _Acceleration(selfx, selfy, othx , othy, quad.particlesINquad[0].mass)    # Compute the acceleration
-            self.aX += aX
-            self.aY += aY
-        elif len(quad.particlesINquad) > 1:
-            d = self.RelDist(from_pg( quad.center_mass ) )                       # Distance between 'self' and the center of mass
-            l = quad.w
-            if l / d <= quad.theta:                                              # Check if particles act as their center of mass
-                selfx, selfy = from_pg( (self.x, self.y) )                             # ↓
-                othx , othy  = from_pg( quad.center_mass )                             # ↓
-                aX, aY = _Acceleration(selfx, selfy, othx , othy, quad.TotMass)        # ↳  Compute the acceleration
-                self.aX += aX 
-                self.aY += aY 
-            else:                                                                # If condition is not verified 
-                for key in quad.keys:                                            # the acceleration is the sum of the
-                    self.checkCases(quad.children[key])                          # childrens accelerations
-                
+
     def computeForce(self, tree):
         """
-        Start of the algorithm that computes the forces on a particle.
+        Compute the forces on a particle.
         """
-        self.aX, self.aY = 0, 0                             # Reset the accelerations
-        for key in tree.RootQuad.keys:                      # Check the children of the Root
-            self.checkCases(tree.RootQuad.children[key])
-    
+        TreeForces(tree, self._set, np.array([self._i]))
+
     def move(self, tree):
         """
         Computes the trajectory of a particle given its acceleartion using the Basic Störmer–Verlet                                               (https://en.wikipedia.org/wiki/Verlet_integration#Basic_St%C3%B6rmer%E2%80%93Verlet) algorithm.
-        It also checks if a particles wander out of the domain, eventually excluding it from the motion.
-        
-        NOTE: this check needs to be modified and a particle be excluded if its velocity is greater than the escape velocity of the system
         """
         if self.skip or self.still: return      # Skip computations if the particle is outside or is set to be unmovable
-        
-        x_n, y_n = from_pg( (self.x, self.y) )
-        x_nm1, y_nm1   = self.x_old, self.y_old
-        
+
+        x_n, y_n     = self._set.pos[self._i]
+        x_nm1, y_nm1 = self.x_old, self.y_old
+
         # Compute the accelerations
         x_np1, y_np1, self.first = _verlet(self.first, x_n, y_n, x_nm1, y_nm1, self.vx, self.vy, self.aX, self.aY, tree.dt)
-        
+
         # Update old and new positions
-        self.x_old, self.y_old = x_n, y_n
-        self.x, self.y         = to_pg( (x_np1, y_np1) )
-        
-        # Check if the particle is still in the Tree()
-        cond = (0 > self.x > WIDTH*self.to_len) or (0 > self.y > HEIGHT*self.to_len)
-        if cond:
-            self.skip = True
-            self.color = (0,255,0)
-    
+        self.vx, self.vy            = (x_np1 - x_n) / tree.dt, (y_np1 - y_n) / tree.dt
+        self.x_old, self.y_old      = x_n, y_n
+        self._set.pos[self._i]      = x_np1, y_np1
+
     def draw(self, SURF):
         """
         Draws a particle.
         """
+        import pygame as pg
         if not self.skip:
             pg.draw.circle(SURF, self.color, (self.x, self.y), self.r)
-            
 
-@njit 
+
+@njit(cache = True)
 def _RelDist(xx, yy, xxx, yyy):
-    return np.sqrt( (xx - xxx)**2 + (yy - yyy)**2 )    
+    return np.sqrt( (xx - xxx)**2 + (yy - yyy)**2 )
 
-@njit
+@njit(cache = True)
 def _verlet(first, x_n, y_n, x_nm1, y_nm1, vx, vy, aX, aY, dt):
     if first:
         x_np1 = x_n + vx * dt + 0.5 * aX * dt**2
         y_np1 = y_n + vy * dt + 0.5 * aY * dt**2
         return x_np1, y_np1, False
     else:
-        x_np1 = 2 * x_n - x_nm1 + aX * dt**2 
-        y_np1 = 2 * y_n - y_nm1 + aY * dt**2 
+        x_np1 = 2 * x_n - x_nm1 + aX * dt**2
+        y_np1 = 2 * y_n - y_nm1 + aY * dt**2
         return x_np1, y_np1, False
 
-@njit
-def _Acceleration(selfx, selfy, othx, othy, mass):
-    r2 = _RelDist(selfx, selfy, othx, othy)**2
-    aX  =  G * mass * (othx - selfx) / (r2 + a2)**(3/2)
-    aY  =  G * mass * (othy - selfy) / (r2 + a2)**(3/2)
-    return aX, aY
+@njit(cache = True)
+def _verlet_all(pos, pos_old, vel, acc, first, skip, still, dt):
+    """
+    Störmer–Verlet step of every movable body, in place. The velocities are updated to (x_n+1 - x_n) / dt,
+    they are not needed by the integration but they are stored in the snapshots.
+    """
+    for i in range(pos.shape[0]):
+        if skip[i] or still[i]:
+            continue
+        x_np1, y_np1, first[i] = _verlet(first[i], pos[i, 0], pos[i, 1], pos_old[i, 0], pos_old[i, 1],
+                                         vel[i, 0], vel[i, 1], acc[i, 0], acc[i, 1], dt)
+        vel[i, 0], vel[i, 1]         = (x_np1 - pos[i, 0]) / dt, (y_np1 - pos[i, 1]) / dt
+        pos_old[i, 0], pos_old[i, 1] = pos[i, 0], pos[i, 1]
+        pos[i, 0], pos[i, 1]         = x_np1, y_np1
 
 
 def DrawAllParticles(tree, SURF):
     """
-    Draw all particles in the Tree object, starting from the root and descending into the children.
+    Draw all particles in the Tree object.
     """
     quad = tree.RootQuad
-    for key in quad.keys:
-        quad.children[key].draw_particles(SURF)
\ No newline at end of file
+    quad.particles.draw(SURF, quad.particlesINquad)
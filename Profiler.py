@@ -0,0 +1,165 @@
+import json
+import sys
+import threading
+import time
+import numpy as np
+
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from Gravity import WalkStats
+
+
+class Profiler():
+    """
+    Named timers and counters for the phases of a step. Every phase is timed with
+
+        with profiler.timer('forces'):
+            ...
+
+    and end_step() closes the step: its timers and counters become a row of 'rows', written as a JSON line to
+    'path' if not None. The timers are exclusive: the time of a phase timed inside another one (the tree built
+    by the diagnostics, say) counts only for the inner phase, so that the shares add up to the whole step. summary() gives the totals of the run. A disabled profiler costs one attribute lookup
+    per phase. With 'sample' > 0 a StackSampler() records where the main thread spends its time, every
+    'sample' seconds.
+    """
+
+    def __init__(self, path = None, enabled = True, sample = 0, count_every = 10):
+        """
+            - path        : JSON lines log with one row per step
+            - count_every : steps between two counts of the tree walk, see count_tree()
+        """
+        self.enabled = enabled
+        self.path    = path
+        self.count_every = count_every
+        self.rows    = []
+        self._step   = {}
+        self._inner  = []                         # Time of the inner phases of the open timers
+        self._file   = open(path, 'w') if (enabled and path is not None) else None
+        self.sampler = StackSampler(sample) if (enabled and sample > 0) else None
+
+    @contextmanager
+    def _timer(self, name):
+        t1 = time.perf_counter()
+        self._inner.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t1
+            self._step[name] = self._step.get(name, 0.) + elapsed - self._inner.pop()
+            if self._inner:
+                self._inner[-1] += elapsed
+
+    def timer(self, name):
+        """
+        Context manager adding the time spent inside it, less that of the timers opened inside it, to the phase
+        'name' of the current step.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._timer(name)
+
+    def add(self, name, value = 1):
+        """
+        Add 'value' to the counter 'name' of the current step.
+        """
+        if self.enabled:
+            self._step[name] = self._step.get(name, 0) + value
+
+    def count_tree(self, tree, particles, step, targets = None):
+        """
+        Every 'count_every' steps, count the nodes, the depth of the tree and the interactions of the walk,
+        see Gravity.WalkStats(). This walks the tree a second time, so it is timed apart as 'counting'.
+        """
+        if not self.enabled or self.count_every <= 0 or step % self.count_every != 0:
+            return
+        with self.timer('counting'):
+            self._step['nodes'] = tree.n_nodes
+            self._step['depth'] = int(round(np.log2(tree.node_w[0] / tree.node_w.min())))
+            for name, value in WalkStats(tree, particles, targets).items():
+                self.add(name, value)
+
+    def end_step(self, step):
+        """
+        Close the current step: store its timers and counters in 'rows' and in the log.
+        """
+        if not self.enabled:
+            return
+        row = dict(step = step, **self._step)
+        self.rows.append(row)
+        self._step = {}
+        if self._file is not None:
+            self._file.write(json.dumps(row) + '\n')
+
+    def summary(self, title = 'Profile'):
+        """
+        Table with the total, mean and maximum time of every phase and the mean of every counter.
+        """
+        if not self.enabled or len(self.rows) == 0:
+            return ''
+        names = []
+        for row in self.rows:
+            names += [key for key in row if key != 'step' and key not in names]
+        timers   = [name for name in names if any(isinstance(row.get(name), float) for row in self.rows)]
+        counters = [name for name in names if name not in timers]
+        total = sum(sum(row.get(name, 0.) for row in self.rows) for name in timers)
+
+        lines = [f'{title}: {len(self.rows)} steps',
+                 f'{"phase":>12} {"total [s]":>10} {"mean [ms]":>10} {"max [ms]":>10} {"share":>7}']
+        for name in timers:
+            values = np.array([row.get(name, 0.) for row in self.rows])
+            lines.append(f'{name:>12} {values.sum():>10.3f} {1e3 * values.mean():>10.3f} {1e3 * values.max():>10.3f} '
+                         f'{100 * values.sum() / max(total, 1e-300):>6.1f}%')
+        for name in counters:
+            values = [row[name] for row in self.rows if name in row]
+            lines.append(f'{name:>12} mean {np.mean(values):.4g} over {len(values)} steps')
+        if self.sampler is not None:
+            lines.append(self.sampler.summary())
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StackSampler():
+    """
+    Sampling profiler: a background thread looks at the stack of the thread that created it every 'interval'
+    seconds and counts the innermost Python function. The compiled kernels show up as the Python line that
+    called them.
+    """
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.counts   = Counter()
+        self.n        = 0
+        self._target  = threading.get_ident()
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            code = frame.f_code
+            self.counts[f'{code.co_filename.split("/")[-1]}:{code.co_name}:{frame.f_lineno}'] += 1
+            self.n += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self, top = 10):
+        lines = [f'Samples: {self.n} every {1e3 * self.interval:g} ms']
+        for where, n in self.counts.most_common(top):
+            lines.append(f'{100 * n / max(1, self.n):>6.1f}%  {where}')
+        return '\n'.join(lines)
+
+
+global NoProfiler
+NoProfiler = Profiler(enabled = False)
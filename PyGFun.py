@@ -1,11 +1,10 @@
-import pygame as pg
 import numpy as np
 from numba import njit
 
 global WIDTH, HEIGHT
 WIDTH, HEIGHT = 1000, 1000
 
-@njit
+@njit(cache = True)
 def _to_pg(coords):
     """Numba-ed version of to_pg."""
     return (WIDTH / 2 + coords[0], HEIGHT / 2 + coords[1])
@@ -14,20 +13,21 @@ def to_pg(coords):
     """Convert coordinates into pygame coordinates."""
     return _to_pg(np.array(coords))
 
-@njit
+@njit(cache = True)
 def from_pg(coords):
     """Convert coordinates from pygame coordinates."""
     return (coords[0] - WIDTH / 2, coords[1] - HEIGHT / 2)
 
 
-def check_Event_Logic(run, show_tree, tree, SURF):
+def check_Event_Logic(run, show_tree, paused):
     """
     Handels the button pressed:
         - quit button
         - t        : show/hide tree
         - SpaceBar : pause/unpause
+    Returns the new show_tree, run and paused flags, without waiting for events.
      """
-    from Particle import DrawAllParticles
+    import pygame as pg
     
     for event in pg.event.get():
             if event.type == pg.QUIT: run = False
@@ -35,17 +35,5 @@ def check_Event_Logic(run, show_tree, tree, SURF):
                 # Show Tree
                 if event.key == ord ("t"): show_tree = not show_tree 
                 # Pause
-                if event.key == (pg.K_SPACE):
-                    while True: # Infinite loop that will be broken when the user press the space bar again
-                        event = pg.event.wait()
-                        if event.type == pg.KEYDOWN and event.key == pg.K_SPACE: break #Exit infinite loop
-                        # Show/hide tree during pause
-                        if event.type == pg.KEYDOWN and event.key == ord ("t"): 
-                            show_tree = not show_tree
-                            SURF.fill((0, 0, 26, 1))
-                            if show_tree: tree.draw(SURF)
-                            DrawAllParticles(tree, SURF)
-                            pg.display.update()
-                        # Quit during pause
-                        if event.type == pg.QUIT: run = False; break                        
-    return show_tree, run
+                if event.key == (pg.K_SPACE): paused = not paused
+    return show_tree, run, paused
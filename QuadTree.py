@@ -1,140 +1,283 @@
 import numpy as np
-import pygame as pg
 from numba import njit
 
-from Particle import Particle
-
 from PyGFun import to_pg, from_pg, WIDTH, HEIGHT
 global WIDTH, HEIGHT
 
+global MAX_DEPTH, BOUNDS_MARGIN
+MAX_DEPTH = 30                    # Bits per axis of the Morton keys, i.e. maximum depth of the tree
+BOUNDS_MARGIN = 0.1               # Relative margin of the adaptive root quad around the bodies, see Bounds()
+
+#   __________        The slots of the flat child array follow the Morton order
+#  | 11 | 10 |        (bit 0: x >= center, bit 1: y >= center), KEY_SLOT maps
+#  |____|____|        the keys of the quads onto them.
+#  | 01 | 00 |
+#  |____|____|
+KEY_SLOT = {'00': 3, '01': 2, '10': 1, '11': 0}
+
 
 class Tree():
-    
-    def __init__(self, _quad):
+
+    def __init__(self, _quad, rebuild_every = 1, max_crossed = 1.0, max_leaf = None, multipole = 1, leaf_size = 1,
+                 adaptive = False, precision = 'float64'):
+        """
+        Between two full builds the tree is refitted by update(), see there for the meaning of
+        'rebuild_every', 'max_crossed' and 'max_leaf'. With rebuild_every = 1 the tree is rebuilt at every update.
+        If None, 'max_leaf' is twice 'leaf_size' and at least 8, so that the refit has room to put bodies in
+        the leaves that the build filled up to 'leaf_size'.
+        'multipole' is the order of the far-field approximation: 1 for monopoles only, 2 to add the quadrupoles.
+        Nodes with at most 'leaf_size' bodies are not split: with leaf_size > 1 the forces are computed
+        with one walk per leaf, see Gravity.TreeForces().
+        With 'adaptive' the root quad is recomputed from the bounds of the bodies at every build, see Bounds(),
+        otherwise it stays the quad '_quad' and the bodies outside it are left out of the tree.
+        With precision 'float32' the moments of the nodes and the positions and masses read by the walks
+        (walk_pos, walk_mass) are stored in single precision, see store().
+        """
         self.RootQuad = _quad
+        self.particles = _quad.particles
+        self.theta = _quad.theta
         self.dt = 1/20
         self.fused = None
         self.N_0 = None
-        
+
+        self.rebuild_every = rebuild_every
+        self.max_crossed   = max_crossed
+        self.max_leaf      = max(8, 2 * leaf_size) if max_leaf is None else max_leaf
+        self.multipole     = multipole
+        self.leaf_size     = leaf_size
+        self.adaptive      = adaptive
+        if precision not in ('float64', 'float32'):
+            raise ValueError(f'Unknown precision {precision}')
+        self.precision     = precision
+        self.steps_since_build = 0
+        self.n_builds      = 0
+        self.n_refits      = 0
+        self.n_reinserted  = 0
+
     def __str__(self):
         return  str(self.__class__) + '\n'+ '\n'.join(('{} = {}'.format(item, self.__dict__[item]) for item in self.__dict__))
-    
+
     def createTree(self):
         """
-        Starts the algorithm to create the Tree()
+        Build the tree: the bodies in the root quad are sorted along the Morton (Z-order) curve and the sorted
+        ranges are split into the flat node arrays
+            - order              : indices of the bodies, sorted by Morton key
+            - node_child         : (M, 4) indices of the children (-1 if the quadrant is empty)
+            - node_leaf          : True for the nodes without children
+            - node_start/node_end: range of 'order' holding the bodies of each node
+            - node_center/node_w : geometric center and width of each node
+            - node_cm/node_mass  : center of mass and total mass of each node
+            - node_quad          : (M, 3) quadrupole moments (Qxx, Qxy, Qyy) if multipole > 1, empty otherwise
+        """
+        root = self.RootQuad
+        cx, cy = from_pg(root.center)
+        (self.order, self.node_child, self.node_leaf, self.node_start, self.node_end, self.node_center, self.node_w,
+         self.node_cm, self.node_mass, self.node_quad) = _build_tree(self.particles.pos, self.particles.mass,
+                                                                     root.particlesINquad, cx, cy, float(root.w),
+                                                                     self.multipole, self.leaf_size)
+        self.store()
+        self.RootQuad  = Quad.view(self, 0, root.color)
+        self.steps_since_build = 0
+        self.n_builds += 1
+
+    def rebuild(self):
+        """
+        Build the tree from scratch on all the bodies that are not skipped, keeping the root quad or fitting it
+        to the bodies if 'adaptive'.
+        """
+        root = self.RootQuad
+        center, w = Bounds(self.particles) if self.adaptive else (root.center, root.w)
+        self.RootQuad = Quad(center, w, self.particles, _color = root.color, _theta = self.theta)
+        self.createTree()
+
+    def update(self):
+        """
+        Update the tree after the bodies moved. The cached nodes are refitted: only the bodies that crossed the
+        boundary of their leaf are re-inserted and the centers of mass and masses are recomputed bottom-up.
+        The tree is rebuilt from scratch instead if
+            - 'rebuild_every' updates went by since the last build,
+            - more than a fraction 'max_crossed' of the bodies crossed the boundary of their leaf (never with
+              the default 1: with one body per leaf a quarter to four fifths of the bodies change leaf at every
+              step, and re-inserting them still costs less than a build),
+            - a leaf ends up with more than 'max_leaf' bodies (or 'leaf_size', if larger),
+            - with 'adaptive', a body left the root quad.
+        """
+        self.steps_since_build += 1
+        inside = True
+        if self.adaptive:
+            cx, cy = from_pg(self.RootQuad.center)
+            inside = _all_inside(self.particles.pos, self.particles.skip, cx, cy, self.RootQuad.w / 2)
+        if inside and self.steps_since_build < self.rebuild_every:
+            max_crossed = int(self.max_crossed * len(self.order))
+            out = _refit(self.particles.pos, self.particles.mass, self.order, self.node_child, self.node_leaf,
+                         self.node_start, self.node_end, self.node_center, self.node_w, max_crossed,
+                         max(self.max_leaf, self.leaf_size), self.multipole)
+            if out[0] >= 0:
+                (self.order, self.node_child, self.node_leaf, self.node_start, self.node_end, self.node_center,
+                 self.node_w, self.node_cm, self.node_mass, self.node_quad) = out[1:]
+                self.store()
+                self.RootQuad = Quad.view(self, 0, self.RootQuad.color)
+                self.n_refits += 1
+                self.n_reinserted += out[0]
+                return
+        self.rebuild()
+
+    def store(self):
+        """
+        Convert the moments of the nodes, computed in double precision, to the precision of the tree and take
+        the positions and masses of the bodies read by the walks: the arrays of the ParticleSet() in double
+        precision, single precision copies otherwise. The walks accumulate the forces in double precision
+        either way, and the bodies are integrated on their double precision positions.
         """
-        return self.check_and_split(self.RootQuad)
-        
-    def check_and_split(self, quad):
+        dtype = np.float32 if self.precision == 'float32' else np.float64
+        self.node_cm   = self.node_cm.astype(dtype, copy = False)
+        self.node_mass = self.node_mass.astype(dtype, copy = False)
+        self.node_quad = self.node_quad.astype(dtype, copy = False)
+        self.walk_pos  = self.particles.pos.astype(dtype, copy = False)
+        self.walk_mass = self.particles.mass.astype(dtype, copy = False)
+
+    def walk_bytes(self):
+        """
+        Memory read by the walks of the tree: positions and masses of the bodies and moments of the nodes.
         """
-        Then it checks if the quad needs to be split, keeping track of the subsequent possible collisions.
+        return sum(a.nbytes for a in (self.walk_pos, self.walk_mass, self.node_cm, self.node_mass, self.node_quad))
+
+    def stats(self):
         """
-        if len(quad.particlesINquad) > 1:              # If there is more than one particle in the quad
-                quad.SplitQuad()                       # split the quad
-                for key in quad.keys:                  # Check the children
-                    self.check_and_split(quad.children[key])
-    
+        Summary of the builds and refits of the tree.
+        """
+        return (f'Tree: {self.n_builds} builds, {self.n_refits} refits, '
+                f'{self.n_reinserted} re-inserted bodies, {self.n_nodes} nodes')
+
+    @property
+    def n_nodes(self):
+        return len(self.node_mass)
+
+    def boxes(self):
+        """
+        (K, 3) array with center and width of the squares drawn by draw(), in simulation coordinates: the
+        quadrants, empty or not, of every node that has children, unless they have children themselves.
+        """
+        return _boxes(self.node_child, self.node_leaf, self.node_center, self.node_w)
+
     def find_particles(self, quad):
         """
-        Create a list with all the particles in the tree. Needed to update the praticle list after the collisions.
+        Create a ParticleSet() with all the particles in the tree. Needed to update the praticle list after the collisions.
         """
-        outs = []
-        if quad.children['00'] == None:
-            return quad.particlesINquad
-        else:
-            for key in quad.keys:
-                outs.extend(self.find_particles(quad.children[key]))
-        return outs
-    
+        return quad.particles[np.sort(quad.particlesINquad)]
+
     def draw(self, SURF):
         """
-        Draw the entire tree starting from the Root quad.
+        Draw the entire tree starting from the Root quad, in a single pass over the flat node arrays.
         """
-        quad = self.RootQuad
-        for key in quad.keys:
-            quad.children[key].draw(SURF)
+        from Render import Renderer
+        Renderer(tree_color = self.RootQuad.color).draw(SURF, np.zeros((0, 2)), boxes = self.boxes())
+
+def Bounds(particles, margin = BOUNDS_MARGIN):
+    """
+    Center (pygame coordinates) and width of the square enclosing the bodies that are not skipped, enlarged by
+    the fraction 'margin' so that the bodies can move for a few refits before leaving it.
+    """
+    idx = np.flatnonzero(~particles.skip)
+    if len(idx) == 0:
+        return to_pg((0, 0)), 1.
+    lo, hi = particles.pos[idx].min(axis = 0), particles.pos[idx].max(axis = 0)
+    w = max(hi[0] - lo[0], hi[1] - lo[1], 1e-6) * (1 + margin)
+    return to_pg((0.5 * (lo[0] + hi[0]), 0.5 * (lo[1] + hi[1]))), float(w)
+
 
 class Quad():
-    
-    def __init__(self, _center, _w, _particlesINquad, _color = (3,120,19), _h=None, _theta=0.8):
+
+    def __init__(self, _center, _w, _particles, _particlesINquad = None, _color = (3,120,19), _h=None, _theta=0.8):
+        """
+        '_particles' is the ParticleSet() of the simulation and '_particlesINquad' the indices of the bodies in the quad
+        (all the bodies that are not skipped if None).
+        Once the Tree() is built every quad is a view on one of its nodes, see Quad.view().
+        """
         self.done  = False
         self.color = _color
-        
+        self._tree = None
+        self._node = -1
+        self._children = None
+
         if _h == None:
             _h = _w
-        
+
         self.center = _center
         self.w = _w
         self.h = _h
-        
+
+        if _particlesINquad is None:
+            _particlesINquad = np.flatnonzero(~_particles.skip)
+        self.particles       = _particles
         self.particlesINquad = _particlesINquad
         if len(_particlesINquad) > 0:
             self.center_mass, self.TotMass = self.computeCM()
         else:
             self.done = True
-            
+
         self.theta = _theta
-            
-        self.children = {}           #   __________ 
-        self.children['00'] = None   #  | 11 | 10 |
-        self.children['01'] = None   #  |____|____|
-        self.children['10'] = None   #  | 01 | 00 |
-        self.children['11'] = None   #  |____|____|
         self.keys = ['00', '01', '10', '11']
-        
-    def SplitQuad(self):
-        """
-        Compute the centers of the four children and passes them to another function.
-        """
-        center = from_pg(self.center)
-        w, h   = self.w, self.h
-        # Compute N-W center
-        NW_center = (center[0] + w / 4, center[1] + h / 4)
-        # Compute N-E center
-        NE_center = (center[0] - w / 4, center[1] + h / 4)
-        # Compute S-W center
-        SW_center = (center[0] + w / 4, center[1] - h / 4)
-        # Compute S-E center
-        SE_center = (center[0] - w / 4, center[1] - h / 4)
-        self.quadChildren([NW_center, NE_center, SW_center, SE_center], w / 2, h / 2)
-    
-    def quadChildren(self, centers, w, h):
-        """
-        Find the particles in each children and create the four quads. 
-        """
-        for i, key in enumerate(self.keys):
-            part = self.countParticles(centers[i], w, h)
-            self.children[key] = Quad(to_pg(centers[i]), w, part)
+
+    @classmethod
+    def view(cls, tree, node, _color = (3,120,19)):
+        """
+        Return the Quad() corresponding to the node 'node' of 'tree'.
+        """
+        self = cls.__new__(cls)
+        self._tree, self._node, self._children = tree, node, None
+        self.done   = False
+        self.color  = _color
+        self.center = to_pg(tree.node_center[node])
+        self.w = self.h = tree.node_w[node]
+        self.particles       = tree.particles
+        self.particlesINquad = tree.order[tree.node_start[node]:tree.node_end[node]]
+        self.center_mass, self.TotMass = self.computeCM()
+        self.theta = tree.theta
+        self.keys  = ['00', '01', '10', '11']
+        return self
+
+    @property
+    def children(self):
+        """
+        The four children of the quad, None if the quad is a leaf.
+        """
+        if self._children is None:
+            tree, node = self._tree, self._node
+            if tree is None or tree.node_leaf[node]:
+                self._children = {key: None for key in self.keys}
+            else:
+                self._children = {}
+                cx, cy = from_pg(self.center)
+                for key in self.keys:
+                    child = tree.node_child[node, KEY_SLOT[key]]
+                    if child >= 0:
+                        self._children[key] = Quad.view(tree, child, self.color)
+                    else:                                                        # Empty quadrant
+                        sx = 1 if KEY_SLOT[key] & 1 else -1
+                        sy = 1 if KEY_SLOT[key] & 2 else -1
+                        center = to_pg((cx + sx * self.w / 4, cy + sy * self.h / 4))
+                        self._children[key] = Quad(center, self.w / 2, self.particles, tree.order[:0],
+                                                   self.color, _theta = self.theta)
+        return self._children
 
     def computeCM(self):
         """
         Compute the center of mass and total mass of a quad.
         """
-        cmX = 0
-        cmY = 0
-        M = 0
-        for particle in self.particlesINquad:
-            xx, yy = from_pg( (particle.x, particle.y) )
-            M += particle.mass
-            cmX += particle.mass *  xx
-            cmY += particle.mass *  yy
-        return to_pg((cmX / M, cmY / M)), M  
-
-    def countParticles(self, center, w, h):
-        """
-        Find which particles are in a quad's children.
-        """
-        parts = []
-        for particle in self.particlesINquad:
-            x, y = from_pg((particle.x, particle.y))
-            if (center[0] - w/2 <= x < center[0] + w/2) and (center[1] - h/2 <= y < center[1] + h/2):
-                parts.append(particle)
-        return parts  
-    
+        if self._tree is not None:
+            return to_pg(self._tree.node_cm[self._node]), self._tree.node_mass[self._node]
+        mass = self.particles.mass[self.particlesINquad]
+        pos  = self.particles.pos[self.particlesINquad]
+        M = mass.sum()
+        cmX, cmY = mass @ pos
+        return to_pg((cmX / M, cmY / M)), M
+
     def draw(self, SURF):
         """
         Draw a quad or its children.
         """
+        import pygame as pg
         if self.children['00'] == None:
             rect = pg.Rect(0, 0, self.w, self.h)
             rect.center = self.center
@@ -142,14 +285,325 @@ class Quad():
         else:
             for key in self.keys:
                 self.children[key].draw(SURF)
-                
+
     def draw_particles(self, SURF):
         """
-        Draw all the particles in a quad if it has no children or goes deeper in the tree.
+        Draw all the particles in a quad.
         """
-        if self.children['00'] == None:
-            for particle in self.particlesINquad:
-                particle.draw(SURF)
+        self.particles.draw(SURF, self.particlesINquad)
+
+
+@njit(cache = True)
+def _spread_bits(v):
+    """
+    Interleave the bits of 'v' with zeros, i.e. move bit k to bit 2k.
+    """
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v <<  8)) & 0x00FF00FF00FF00FF
+    v = (v | (v <<  4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v <<  2)) & 0x3333333333333333
+    v = (v | (v <<  1)) & 0x5555555555555555
+    return v
+
+@njit(cache = True)
+def _morton_keys(pos, idx, x0, y0, w):
+    """
+    Morton keys of the bodies 'idx' in the square of side 'w' and lower left corner (x0, y0).
+    Bodies outside the square get the key -1.
+    """
+    n_cells = 1 << MAX_DEPTH
+    scale = n_cells / w
+    keys = np.empty(len(idx), dtype = np.int64)
+    for k in range(len(idx)):
+        i = idx[k]
+        fx = (pos[i, 0] - x0) * scale
+        fy = (pos[i, 1] - y0) * scale
+        if fx < 0 or fy < 0 or fx >= n_cells or fy >= n_cells:
+            keys[k] = -1
         else:
-            for key in self.keys:
-                self.children[key].draw_particles(SURF)
\ No newline at end of file
+            keys[k] = _spread_bits(np.int64(fx)) | (_spread_bits(np.int64(fy)) << 1)
+    return keys
+
+@njit(cache = True)
+def _grow(a, size):
+    out = np.empty((size,) + a.shape[1:], dtype = a.dtype)
+    out[:a.shape[0]] = a
+    return out
+
+def _build_tree(pos, mass, idx, cx, cy, w, multipole, leaf_size):
+    """
+    Tree builder, see Tree.createTree().
+    """
+    keys = _morton_keys(pos, idx, cx - w / 2, cy - w / 2, w)
+    perm = np.argsort(keys)
+    keys = keys[perm]
+    first = np.searchsorted(keys, 0)                                  # Drop the bodies outside the root
+    return _split_nodes(pos, mass, keys[first:], idx[perm[first:]], cx, cy, w, multipole, leaf_size)
+
+@njit(cache = True)
+def _split_nodes(pos, mass, keys, order, cx, cy, w, multipole, leaf_size):
+    """
+    Compiled splitting of the Morton-sorted bodies into the nodes. Nodes are stored in creation order,
+    so a parent always comes before its children and the children of a node are contiguous.
+    """
+    n = len(order)
+
+    cap = 2 * n + 16
+    child  = np.full((cap, 4), -1, dtype = np.int64)
+    start  = np.zeros(cap, dtype = np.int64)
+    end    = np.zeros(cap, dtype = np.int64)
+    depth  = np.zeros(cap, dtype = np.int64)
+    center = np.zeros((cap, 2))
+    width  = np.zeros(cap)
+    leaf   = np.zeros(cap, dtype = np.bool_)
+
+    start[0], end[0], center[0, 0], center[0, 1], width[0] = 0, n, cx, cy, w
+    n_nodes = 1
+    stack = np.empty(4 * (MAX_DEPTH + 1), dtype = np.int64)
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        s, e, d = start[node], end[node], depth[node]
+        if e - s <= leaf_size or d == MAX_DEPTH:
+            leaf[node] = True
+            continue
+        shift = 2 * (MAX_DEPTH - 1 - d)
+        base = (keys[s] >> (shift + 2)) << (shift + 2)
+        lo = s
+        for q in range(4):
+            hi = e if q == 3 else _lower_bound(keys, lo, e, base + ((q + 1) << shift))
+            if hi > lo:
+                if n_nodes == cap:
+                    cap *= 2
+                    child, start, end = _grow(child, cap), _grow(start, cap), _grow(end, cap)
+                    depth, center, width = _grow(depth, cap), _grow(center, cap), _grow(width, cap)
+                    leaf = _grow(leaf, cap)
+                    child[n_nodes:] = -1
+                    leaf[n_nodes:]  = False
+                c = n_nodes
+                n_nodes += 1
+                child[node, q] = c
+                start[c], end[c], depth[c], width[c] = lo, hi, d + 1, width[node] / 2
+                center[c, 0] = center[node, 0] + (0.25 if q & 1 else -0.25) * width[node]
+                center[c, 1] = center[node, 1] + (0.25 if q & 2 else -0.25) * width[node]
+                stack[top] = c
+                top += 1
+            lo = hi
+
+    child, start, end = child[:n_nodes].copy(), start[:n_nodes].copy(), end[:n_nodes].copy()
+    center, width, leaf = center[:n_nodes].copy(), width[:n_nodes].copy(), leaf[:n_nodes].copy()
+    cm, M, Q = _moments(pos, mass, order, child, leaf, start, end, center, multipole)
+    return order, child, leaf, start, end, center, width, cm, M, Q
+
+@njit(cache = True)
+def _lower_bound(keys, lo, hi, value):
+    """
+    First index in keys[lo:hi] (sorted) whose key is not smaller than 'value'.
+    """
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if keys[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+@njit(cache = True)
+def _refit(pos, mass, order, child, leaf, start, end, center, width, max_crossed, max_leaf, multipole):
+    """
+    Compiled refit of the tree, see Tree.update(). Returns the number of re-inserted bodies followed by the new
+    arrays, or -1 followed by the old arrays if the tree needs to be rebuilt.
+    """
+    n = len(order)
+    n_nodes = child.shape[0]
+    failed = (-1, order, child, leaf, start, end, center, width, center, width, center)
+
+    # Find the bodies that left their leaf
+    crossed = np.zeros(n, dtype = np.bool_)
+    n_crossed = 0
+    for node in range(n_nodes):
+        if not leaf[node]:
+            continue
+        h = width[node] / 2
+        for k in range(start[node], end[node]):
+            i = order[k]
+            if not (center[node, 0] - h <= pos[i, 0] < center[node, 0] + h and
+                    center[node, 1] - h <= pos[i, 1] < center[node, 1] + h):
+                crossed[k] = True
+                n_crossed += 1
+                if n_crossed > max_crossed:
+                    return failed
+
+    # Find the new leaf of the bodies that crossed, adding leaves in the empty quadrants
+    cap = n_nodes + n_crossed
+    child, leaf, start, end = _grow(child, cap), _grow(leaf, cap), _grow(start, cap), _grow(end, cap)
+    center, width = _grow(center, cap), _grow(width, cap)
+    target = np.full(n_crossed, -1, dtype = np.int64)
+    moved  = np.empty(n_crossed, dtype = np.int64)
+    m = 0
+    for k in range(n):
+        if not crossed[k]:
+            continue
+        i = order[k]
+        moved[m] = i
+        h = width[0] / 2
+        if not (center[0, 0] - h <= pos[i, 0] < center[0, 0] + h and center[0, 1] - h <= pos[i, 1] < center[0, 1] + h):
+            m += 1                                                    # Left the root, drop it
+            continue
+        node = 0
+        while not leaf[node]:
+            q = (1 if pos[i, 0] >= center[node, 0] else 0) + (2 if pos[i, 1] >= center[node, 1] else 0)
+            if child[node, q] < 0:
+                c = n_nodes
+                n_nodes += 1
+                child[c, :] = -1
+                leaf[c] = True
+                start[c], end[c] = 0, 0
+                width[c] = width[node] / 2
+                center[c, 0] = center[node, 0] + (0.25 if q & 1 else -0.25) * width[node]
+                center[c, 1] = center[node, 1] + (0.25 if q & 2 else -0.25) * width[node]
+                child[node, q] = c
+            node = child[node, q]
+        target[m] = node
+        m += 1
+    child, leaf, start, end = child[:n_nodes], leaf[:n_nodes], start[:n_nodes], end[:n_nodes]
+    center, width = center[:n_nodes], width[:n_nodes]
+
+    # Bodies to append to every leaf
+    n_in = np.zeros(n_nodes + 1, dtype = np.int64)
+    for m in range(n_crossed):
+        if target[m] >= 0:
+            n_in[target[m] + 1] += 1
+    first_in = np.cumsum(n_in)
+    fill = first_in[:-1].copy()
+    inserted = np.empty(first_in[-1], dtype = np.int64)
+    for m in range(n_crossed):
+        if target[m] >= 0:
+            inserted[fill[target[m]]] = moved[m]
+            fill[target[m]] += 1
+
+    # Lay the leaves out again in Morton order
+    new_order = np.empty(n - n_crossed + len(inserted), dtype = np.int64)
+    new_start = np.zeros(n_nodes, dtype = np.int64)
+    new_end   = np.zeros(n_nodes, dtype = np.int64)
+    stack = np.empty(4 * (MAX_DEPTH + 1), dtype = np.int64)
+    stack[0] = 0
+    top = 1
+    cursor = 0
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if leaf[node]:
+            new_start[node] = cursor
+            for k in range(start[node], end[node]):
+                if not crossed[k]:
+                    new_order[cursor] = order[k]
+                    cursor += 1
+            for k in range(first_in[node], first_in[node + 1]):
+                new_order[cursor] = inserted[k]
+                cursor += 1
+            new_end[node] = cursor
+            if new_end[node] - new_start[node] > max_leaf:
+                return failed
+        else:
+            for q in range(3, -1, -1):
+                if child[node, q] >= 0:
+                    stack[top] = child[node, q]
+                    top += 1
+    for node in range(n_nodes - 1, -1, -1):
+        if not leaf[node]:
+            new_start[node], new_end[node] = cursor, 0
+            for q in range(4):
+                c = child[node, q]
+                if c >= 0:
+                    new_start[node] = min(new_start[node], new_start[c])
+                    new_end[node]   = max(new_end[node], new_end[c])
+
+    child, leaf, center, width = child.copy(), leaf.copy(), center.copy(), width.copy()
+    cm, M, Q = _moments(pos, mass, new_order, child, leaf, new_start, new_end, center, multipole)
+    return n_crossed, new_order, child, leaf, new_start, new_end, center, width, cm, M, Q
+
+@njit(cache = True)
+def _moments(pos, mass, order, child, leaf, start, end, center, multipole):
+    """
+    Centers of mass and total masses of all the nodes, computed bottom-up. If multipole > 1 also the
+    quadrupole moments Q = sum m (3 d d - |d|^2 I) about the centers of mass, stored as (Qxx, Qxy, Qyy).
+    """
+    n_nodes = child.shape[0]
+    cm = np.zeros((n_nodes, 2))
+    M  = np.zeros(n_nodes)
+    Q  = np.zeros((n_nodes if multipole > 1 else 0, 3))
+    for node in range(n_nodes - 1, -1, -1):
+        mx, my, m = 0.0, 0.0, 0.0
+        if leaf[node]:
+            for k in range(start[node], end[node]):
+                i = order[k]
+                m  += mass[i]
+                mx += mass[i] * pos[i, 0]
+                my += mass[i] * pos[i, 1]
+        else:
+            for q in range(4):
+                c = child[node, q]
+                if c >= 0:
+                    m  += M[c]
+                    mx += M[c] * cm[c, 0]
+                    my += M[c] * cm[c, 1]
+        M[node] = m
+        if m > 0:
+            cm[node, 0], cm[node, 1] = mx / m, my / m
+        else:
+            cm[node, 0], cm[node, 1] = center[node, 0], center[node, 1]
+            continue
+
+        if multipole > 1:
+            qxx, qxy, qyy = 0.0, 0.0, 0.0
+            if leaf[node]:
+                for k in range(start[node], end[node]):
+                    i = order[k]
+                    dx, dy = pos[i, 0] - cm[node, 0], pos[i, 1] - cm[node, 1]
+                    qxx += mass[i] * (2 * dx**2 - dy**2)
+                    qxy += mass[i] * 3 * dx * dy
+                    qyy += mass[i] * (2 * dy**2 - dx**2)
+            else:                                                     # Shift the moments of the children
+                for q in range(4):
+                    c = child[node, q]
+                    if c >= 0:
+                        dx, dy = cm[c, 0] - cm[node, 0], cm[c, 1] - cm[node, 1]
+                        qxx += Q[c, 0] + M[c] * (2 * dx**2 - dy**2)
+                        qxy += Q[c, 1] + M[c] * 3 * dx * dy
+                        qyy += Q[c, 2] + M[c] * (2 * dy**2 - dx**2)
+            Q[node, 0], Q[node, 1], Q[node, 2] = qxx, qxy, qyy
+    return cm, M, Q
+
+@njit(cache = True)
+def _all_inside(pos, skip, cx, cy, h):
+    """
+    True if every body not skipped lies in the square of center (cx, cy) and half width h.
+    """
+    for i in range(pos.shape[0]):
+        if not skip[i] and (abs(pos[i, 0] - cx) >= h or abs(pos[i, 1] - cy) >= h):
+            return False
+    return True
+
+@njit(cache = True)
+def _boxes(child, leaf, center, width):
+    out = np.empty((4 * child.shape[0], 3))
+    n = 0
+    for node in range(child.shape[0]):
+        if leaf[node]:
+            continue
+        for q in range(4):
+            c = child[node, q]
+            if c >= 0 and not leaf[c]:
+                continue
+            w = width[node] / 2
+            out[n, 0] = center[node, 0] + (w / 2 if q & 1 else -w / 2)
+            out[n, 1] = center[node, 1] + (w / 2 if q & 2 else -w / 2)
+            out[n, 2] = w
+            n += 1
+    if n == 0:                                                      # Root without children
+        out[0, 0], out[0, 1], out[0, 2] = center[0, 0], center[0, 1], width[0]
+        n = 1
+    return out[:n]
@@ -0,0 +1,112 @@
+import numpy as np
+from numba import njit
+
+from PyGFun import WIDTH, HEIGHT
+global WIDTH, HEIGHT
+
+
+class Renderer():
+    """
+    Draw all the bodies at once into the pixel array of a surface, instead of one pg.draw.circle per body.
+    The positions are projected in a single vectorized operation and splatted by a compiled loop:
+            - mode 'color'  : every body is a disc of radius 'r' with its own color
+            - mode 'mass'   : discs colored by mass, as ParticleSet.color_mapp()
+            - mode 'density': every body adds light to its pixel, shaded with the logarithm of the counts,
+                              so that the dense regions stay readable at large N
+    The squares of the tree are drawn from the array of Tree.boxes() in the same way.
+    """
+
+    def __init__(self, mode = 'color', r = 2, size = (WIDTH, HEIGHT), tint = (255, 255, 255), tree_color = (3,120,19)):
+        if mode not in ('color', 'mass', 'density'):
+            raise ValueError(f'Unknown rendering mode {mode}')
+        self.mode = mode
+        self.r    = r
+        self.size = size
+        self.tint = np.array(tint, dtype = np.float64)
+        self.tree_color = np.array(tree_color, dtype = np.uint8)
+        # Offsets of the pixels of a disc of radius r
+        dx, dy = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1))
+        inside = dx**2 + dy**2 <= r**2
+        self.offsets = np.stack((dx[inside], dy[inside]), axis = 1).astype(np.int64)
+
+    def draw(self, SURF, pos, skip = None, color = None, mass = None, boxes = None):
+        """
+        Draw the bodies at the positions 'pos' (simulation coordinates) that are not skipped on the surface
+        'SURF', and the squares 'boxes' (center and width, see Tree.boxes()) if not None.
+        """
+        import pygame as pg
+        if skip is not None:
+            keep = ~skip
+            pos = pos[keep]
+            color = None if color is None else color[keep]
+            mass  = None if mass is None else mass[keep]
+        px = np.floor(pos[:, 0] + self.size[0] / 2).astype(np.int64)
+        py = np.floor(pos[:, 1] + self.size[1] / 2).astype(np.int64)
+
+        pixels = pg.surfarray.pixels3d(SURF)
+        if boxes is not None and len(boxes) > 0:
+            _outline(pixels, boxes, self.size[0] / 2, self.size[1] / 2, self.size[0], self.size[1], self.tree_color)
+        if self.mode == 'density':
+            counts = np.zeros(self.size, dtype = np.float64)
+            _count(counts, px, py)
+            _shade(pixels, counts, np.log1p(counts.max()), self.tint)
+        else:
+            if self.mode == 'mass':
+                color = np.zeros((len(mass), 3))
+                color[:, 0] = 25.5 * mass / np.sqrt(1 + mass**2 / 100)
+            elif color is None:
+                color = np.broadcast_to(self.tint, (len(px), 3))
+            _splat(pixels, px, py, np.clip(color, 0, 255).astype(np.uint8), self.offsets, self.size[0], self.size[1])
+        del pixels                                                  # Unlock the surface
+
+
+@njit(cache = True)
+def _splat(pixels, px, py, color, offsets, width, height):
+    for i in range(len(px)):
+        for k in range(offsets.shape[0]):
+            x, y = px[i] + offsets[k, 0], py[i] + offsets[k, 1]
+            if 0 <= x < width and 0 <= y < height:
+                pixels[x, y, 0] = color[i, 0]
+                pixels[x, y, 1] = color[i, 1]
+                pixels[x, y, 2] = color[i, 2]
+
+@njit(cache = True)
+def _count(counts, px, py):
+    width, height = counts.shape
+    for i in range(len(px)):
+        if 0 <= px[i] < width and 0 <= py[i] < height:
+            counts[px[i], py[i]] += 1
+
+@njit(cache = True)
+def _shade(pixels, counts, norm, tint):
+    """
+    Add to every pixel the tint scaled by log(1 + count) / norm, saturating at 255.
+    """
+    if norm == 0:
+        return
+    width, height = counts.shape
+    for x in range(width):
+        for y in range(height):
+            if counts[x, y] == 0:
+                continue
+            f = np.log1p(counts[x, y]) / norm
+            for c in range(3):
+                pixels[x, y, c] = min(255, pixels[x, y, c] + int(f * tint[c]))
+
+@njit(cache = True)
+def _outline(pixels, boxes, ox, oy, width, height, color):
+    """
+    One pixel wide outlines of the squares (cx, cy, w), offset by (ox, oy).
+    """
+    for b in range(boxes.shape[0]):
+        h = boxes[b, 2] / 2
+        x0, x1 = int(np.floor(boxes[b, 0] - h + ox)), int(np.floor(boxes[b, 0] + h + ox)) - 1
+        y0, y1 = int(np.floor(boxes[b, 1] - h + oy)), int(np.floor(boxes[b, 1] + h + oy)) - 1
+        for x in range(max(x0, 0), min(x1, width - 1) + 1):
+            for y in (y0, y1):
+                if 0 <= y < height:
+                    pixels[x, y, 0], pixels[x, y, 1], pixels[x, y, 2] = color[0], color[1], color[2]
+        for y in range(max(y0, 0), min(y1, height - 1) + 1):
+            for x in (x0, x1):
+                if 0 <= x < width:
+                    pixels[x, y, 0], pixels[x, y, 1], pixels[x, y, 2] = color[0], color[1], color[2]
@@ -1,7 +1,17 @@
 import numpy as np
 from numba import njit, vectorize
 
-@njit
+def sample_velocity_ratio(n, rng = None):
+    """
+    'n' independent samples of q in [0, 1] with density proportional to q**2 * (1 - q**2)**(7/2), the ratio
+    between speed and escape speed of a Plummer sphere, the distribution of posterior_dist().
+    With u = q**2 the density becomes u**(1/2) * (1 - u)**(7/2), a Beta(3/2, 9/2) distribution, so the samples
+    are drawn at once and exactly, without the burn-in and the correlations of run_sampler().
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    return np.sqrt(rng.beta(1.5, 4.5, size = n))
+
+@njit(cache = True)
 def sample_proposal(mu, sigma):
     """
     This function returns as an output a random number sampled from a distribution.
@@ -11,7 +21,7 @@ def sample_proposal(mu, sigma):
     """
     return np.random.normal(mu, sigma)
 
-@vectorize
+@vectorize(cache = True)
 def posterior_dist(x):
     """
     This function computes the value of the unnormalized posterior distribution from which we want to
@@ -25,7 +35,7 @@ def posterior_dist(x):
         return 0
     
     
-@njit
+@njit(cache = True)
 def run_sampler(starting_point, n_max, burn_in, sigma, seed = None):
     """
     This function runs the Metropolis-Hastings algorithm to sample from the distribution contained in posterior_dist().
@@ -0,0 +1,353 @@
+import numpy as np
+from numba import njit
+
+from FMM import FMMForces
+from Gravity import TreeForces, TreePotential, DirectForces, UseDirect, ClosePairs
+from Integrator import BlockLevels, _kick, _drift, _resync
+from Profiler import NoProfiler
+from QuadTree import Tree, Quad, Bounds
+from Snapshot import SnapshotWriter, Trajectory
+from PyGFun import to_pg, WIDTH, HEIGHT
+global WIDTH, HEIGHT
+
+
+class Simulation():
+    """
+    Physics of the simulation, without any rendering: the tree, the forces and the integration of the bodies.
+    Used both by the pygame loop in NBody.py and by the headless driver in Headless.py.
+    """
+
+    def __init__(self, particles, dt = 1/20, theta = 0.8, workers = None, rebuild_every = 10, max_crossed = 1.0,
+                 max_leaf = None, D = None, N_0 = None, fused = 0, integrator = 'verlet', eta = 0.1, max_level = 6,
+                 multipole = 1, leaf_size = 1, engine = 'bh', order = 4, fmm_theta = 0.4, direct_max_n = None, profiler = None,
+                 compact_every = 100, escape_radius = None, escape_unbound = True, merge_radius = None,
+                 precision = 'float64'):
+        """
+            - particles    : ParticleSet(), initial condition
+            - dt           : time step
+            - theta        : opening angle of the Barnes-Hut walk
+            - multipole    : 1 for monopole nodes, 2 to add the quadrupoles to the far field
+            - leaf_size    : maximum bodies in a leaf, with leaf_size > 1 the forces use one walk per leaf
+            - engine       : 'bh' for the Barnes-Hut walk, 'fmm' for the Fast Multipole Method of FMM.py, where
+                             'fmm_theta' is the separation criterion of the node pairs (smaller than theta for the
+                             same accuracy, see FMM.FMMForces()) and 'order' the degree of the expansions, 'direct'
+                             for the exact sum over the pairs (Gravity.DirectForces()), 'auto'
+                             for 'direct' up to 'direct_max_n' bodies (Gravity.DIRECT_MAX_N if None) and 'bh' above
+            - workers      : number of threads used for the forces, all the cores if None
+            - rebuild_every, max_crossed, max_leaf: refit thresholds of the tree, see Tree.update(); max_leaf
+                             None for twice leaf_size, at least 8
+            - D            : width of the root quad centered on the origin, None to fit the root quad to the
+                             bodies at every build of the tree (see QuadTree.Bounds())
+            - N_0, fused   : initial number of bodies and number of mergers so far
+            - integrator   : 'verlet' for the Störmer–Verlet step with a global dt, 'kdk' for the kick-drift-kick
+                             leapfrog with block time steps dt / 2**level, level <= 'max_level', chosen
+                             with the accuracy parameter 'eta' (see Integrator.BlockLevels()): smaller values
+                             put more bodies on short steps: 0.1 takes about 2.6 force evaluations per body and
+                             step, 0.025 about 5, more than Verlet with dt / 4
+            - profiler     : Profiler() timing the phases 'tree', 'forces' and 'integrate' of every step and
+                             counting the tree walk, the caller closes the steps with profiler.end_step()
+            - compact_every: steps between two calls of compact(), 0 to never remove bodies
+            - escape_radius, escape_unbound: escape criteria of escapers()
+            - merge_radius : bodies closer than this merge at the start of every step (see merge()), None for no
+                             mergers
+            - precision    : 'float32' to store the data read by the tree walks in single precision, see
+                             Tree.store(); the bodies are always integrated in double precision
+        """
+        self.particles = particles
+        self.dt        = dt
+        self.theta     = theta
+        self.multipole = multipole
+        self.leaf_size = leaf_size
+        if engine not in ('bh', 'fmm', 'direct', 'auto'):
+            raise ValueError(f'Unknown engine {engine}')
+        self.engine    = engine
+        self.order     = order
+        self.fmm_theta = fmm_theta
+        self.direct_max_n = direct_max_n
+        self.workers   = workers
+        self.rebuild_every = rebuild_every
+        self.max_crossed   = max_crossed
+        self.max_leaf      = max_leaf
+        self.D         = D
+        self.N_0       = len(particles) if N_0 is None else N_0
+        self.fused     = fused
+        if integrator not in ('verlet', 'kdk'):
+            raise ValueError(f'Unknown integrator {integrator}')
+        self.integrator = integrator
+        self.eta       = eta
+        self.max_level = max_level
+        self.profiler  = NoProfiler if profiler is None else profiler
+        self.compact_every  = compact_every
+        self.escape_radius  = escape_radius
+        self.escape_unbound = escape_unbound
+        self.n_escaped = 0                        # Bodies removed by compact() because they escaped
+        self.n_removed = 0                        # All the bodies removed by compact()
+        self.merge_radius = merge_radius
+        self.precision    = precision
+
+        self.tree   = None
+        self.t      = 0.
+        self.n_step = 0
+        self._moved = True
+        self.n_forces     = 0                     # Number of force evaluations on single bodies
+        self.level_counts = np.zeros(max_level + 1, dtype = np.int64)
+        self._acc_valid   = False
+
+    @classmethod
+    def from_snapshot(cls, path, step = None, **kwargs):
+        """
+        Resume a simulation from the step 'step' (the last one if None) of the trajectory file 'path'.
+        """
+        trajectory = Trajectory(path)
+        k = -1 if step is None else trajectory.find(step)
+        if trajectory.meta['dt'] is not None:
+            kwargs.setdefault('dt', trajectory.meta['dt'])
+        sim = cls(trajectory.particles(k), N_0 = trajectory.N_0, fused = int(trajectory.fused[k]), **kwargs)
+        sim.n_step = int(trajectory.steps[k])
+        sim.t      = float(trajectory.times[k])
+        return sim
+
+    def writer(self, path):
+        """
+        New trajectory file 'path' for the bodies of this simulation, see save().
+        """
+        return SnapshotWriter(path, self.particles, self.N_0, self.dt)
+
+    def save(self, writer):
+        """
+        Queue the current state in the SnapshotWriter() 'writer'.
+        """
+        writer.write(self.particles, self.n_step, self.t, self.fused)
+
+    def updateTree(self):
+        """
+        Build the tree at the first call, then refit or rebuild it if the bodies moved since the last call.
+        """
+        with self.profiler.timer('tree'):
+            if self.tree is None:
+                center, w = Bounds(self.particles) if self.D is None else (to_pg((0,0)), self.D)
+                OuterQuad = Quad(center, w, self.particles, _theta = self.theta)
+                self.tree = Tree(OuterQuad, self.rebuild_every, self.max_crossed, self.max_leaf, self.multipole,
+                                 self.leaf_size, adaptive = self.D is None, precision = self.precision)
+                self.tree.dt = self.dt
+                self.tree.createTree()
+            elif self._moved:
+                self.tree.update()
+        self._moved = False
+        return self.tree
+
+    def currentEngine(self):
+        """
+        Engine used for the forces of the current bodies: 'engine', with 'auto' resolved by Gravity.UseDirect().
+        """
+        if self.engine == 'auto':
+            return 'direct' if UseDirect(np.count_nonzero(~self.particles.skip), self.direct_max_n) else 'bh'
+        return self.engine
+
+    def computeForces(self, targets = None):
+        """
+        Accelerations of the bodies 'targets' (all the bodies not skipped if None) with the selected engine.
+        The tree engines first bring the tree up to date with updateTree(), the direct sum does not use it.
+        The FMM always evaluates the whole field, so with block time steps it pays for all the bodies at every
+        event.
+        """
+        engine = self.currentEngine()
+        if engine != 'direct':
+            self.updateTree()
+        with self.profiler.timer('forces'):
+            if engine == 'fmm':
+                n_m2l, n_p2p = FMMForces(self.tree, self.particles, targets, self.workers, self.order,
+                                         self.fmm_theta)
+            elif engine == 'direct':
+                DirectForces(self.particles, targets, self.workers)
+            else:
+                TreeForces(self.tree, self.particles, targets, self.workers)
+        if engine == 'fmm':
+            self.profiler.add('m2l', n_m2l)
+            self.profiler.add('p2p', n_p2p)
+        elif engine == 'bh':
+            self.profiler.count_tree(self.tree, self.particles, self.n_step, targets)
+
+    def advance(self):
+        """
+        Compute the forces with the selected engine and move all the bodies by one step.
+        """
+        if self.merge_radius:
+            self.merge()
+        if self.integrator == 'kdk':
+            self.advanceBlocks()
+        else:
+            self.computeForces()
+            self.n_forces += np.count_nonzero(~self.particles.skip)
+            with self.profiler.timer('integrate'):
+                self.particles.move(dt = self.dt)
+            self._moved = True
+        self.t += self.dt
+        self.n_step += 1
+        if self.compact_every > 0 and self.n_step % self.compact_every == 0:
+            self.compact()
+
+    def escapers(self):
+        """
+        Indices of the escaped bodies among those not skipped. A body escaped if it is farther than
+        'escape_radius' (if not None) from the center of mass or, with 'escape_unbound', if it is unbound
+        (1/2 v**2 + phi > 0, phi from the tree), moving away from the center of mass and farther than twice the
+        half mass radius. The potential is computed only for the bodies that pass the last two tests.
+        """
+        p = self.particles
+        idx = np.flatnonzero(~p.skip)
+        m = p.mass[idx]
+        M = m.sum()
+        if len(idx) == 0 or M <= 0:
+            return idx[:0]
+        d = p.pos[idx] - m @ p.pos[idx] / M
+        v = p.vel[idx] - m @ p.vel[idx] / M
+        r = np.sqrt(d[:, 0]**2 + d[:, 1]**2)
+        out = np.zeros(len(idx), dtype = np.bool_)
+        if self.escape_radius is not None:
+            out |= r > self.escape_radius
+        if self.escape_unbound:
+            by_r = np.argsort(r)
+            r_half = r[by_r[min(len(idx) - 1, np.searchsorted(np.cumsum(m[by_r]), 0.5 * M))]]
+            far = np.flatnonzero(~out & (r > 2 * r_half) & (np.sum(d * v, axis = 1) > 0))
+            if len(far) > 0:
+                phi = TreePotential(self.updateTree(), p, idx[far], self.workers)
+                out[far[0.5 * np.sum(v[far]**2, axis = 1) + phi > 0]] = True
+        return idx[out]
+
+    def compact(self):
+        """
+        Remove from the arrays of the bodies the escaped ones (see escapers()) and those already skipped, so
+        that they are no longer integrated, drawn or saved, and rebuild the tree on the remaining ones.
+        The ids of the bodies are kept. Returns the number of escaped bodies.
+        """
+        escaped = self.escapers()
+        remove = self.particles.skip.copy()
+        remove[escaped] = True
+        self.n_escaped += len(escaped)
+        self.n_removed += self._shrink(remove)
+        self.profiler.add('escaped', len(escaped))
+        return len(escaped)
+
+    def merge(self):
+        """
+        Sticky mergers: every body closer than 'merge_radius' to another one merges with its nearest neighbour,
+        found on the tree with Gravity.ClosePairs(). The lighter body of a pair is absorbed by the heavier one,
+        which keeps its id and color and takes the total mass and the center of mass position, previous
+        position and velocity of the pair, so that mass and momentum are conserved by both integrators.
+        A body merges at most once per call. The absorbed bodies are removed from the arrays and counted in
+        'fused'. Returns the number of mergers.
+        """
+        p = self.particles
+        partner = ClosePairs(self.updateTree(), p, self.merge_radius, self.workers)
+        n = _merge_pairs(partner, p.pos, p.pos_old, p.vel, p.acc, p.mass, p.skip, p.first, p.still)
+        if n > 0:
+            self.fused += n
+            self._shrink(p.skip)
+            self._acc_valid = False
+        self.profiler.add('merged', n)
+        return n
+
+    def _shrink(self, remove):
+        """
+        Remove the bodies in the mask 'remove' from the arrays and rebuild the tree. Returns their number.
+        """
+        n = np.count_nonzero(remove)
+        if n == 0:
+            return 0
+        self.particles = self.particles[~remove]
+        if self.tree is not None:
+            self.tree.particles = self.particles
+            self.tree.rebuild()
+        self._moved = False
+        return n
+
+    def advanceBlocks(self):
+        """
+        Kick-drift-kick leapfrog over one step dt with hierarchical block time steps. Every body gets the step
+        dt / 2**level required by its acceleration; the bodies are drifted together from one step boundary to
+        the next and only the bodies whose step ends there get their forces recomputed against the refitted
+        tree. All the bodies are synchronized again at the end of dt.
+        """
+        p = self.particles
+        L = self.max_level
+        ticks = 1 << L                                      # Steps of level L in dt
+        movable = np.flatnonzero(~(p.skip | p.still))
+        if not self._acc_valid:
+            self.computeForces(movable)
+            self.n_forces += len(movable)
+
+        timer = self.profiler.timer
+        with timer('integrate'):
+            levels = np.zeros(len(p), dtype = np.int64)
+            _resync(levels, BlockLevels(p.acc, self.dt, self.eta, L), movable, 0, L)
+            self.level_counts += np.bincount(levels[movable], minlength = L + 1)
+            t_start = np.zeros(len(p), dtype = np.int64)
+            _kick(p.vel, p.acc, movable, levels, self.dt)   # Opening half kick
+
+        now = 0
+        while now < ticks:
+            with timer('integrate'):
+                t_end = t_start[movable] + (1 << (L - levels[movable]))
+                t_next = t_end.min()
+                _drift(p.pos, p.vel, p.skip, p.still, (t_next - now) * self.dt / ticks)
+                now = t_next
+                active = movable[t_end == now]
+
+            self._moved = True
+            self.computeForces(active)
+            self.n_forces += len(active)
+            with timer('integrate'):
+                _kick(p.vel, p.acc, active, levels, self.dt)    # Closing half kick
+                if now < ticks:                                 # New step of the active bodies
+                    _resync(levels, BlockLevels(p.acc, self.dt, self.eta, L), active, now, L)
+                    self.level_counts += np.bincount(levels[active], minlength = L + 1)
+                    t_start[active] = now
+                    _kick(p.vel, p.acc, active, levels, self.dt)
+        self._acc_valid = True
+
+    def step(self):
+        """
+        Full step: forces and integration. The tree is brought up to date by the engines that use it, and by the
+        mergers, the compaction and the diagnostics when they need it.
+        """
+        self.advance()
+
+    def finalTree(self):
+        """
+        Tree on the final state of the bodies, carrying the number of initial and merged bodies.
+        """
+        tree = self.updateTree()
+        tree.fused = self.fused
+        tree.N_0   = self.N_0
+        return tree
+
+
+
+@njit(cache = True)
+def _merge_pairs(partner, pos, pos_old, vel, acc, mass, skip, first, still):
+    """
+    Merge every body 'i' with partner[i] >= 0 into the heavier of the two, unless one of them already merged
+    in this call, and mark the absorbed body as skipped. Returns the number of mergers.
+    """
+    done = skip.copy()
+    n = 0
+    for i in range(len(partner)):
+        j = partner[i]
+        if j < 0 or done[i] or done[j]:
+            continue
+        keep, gone = (i, j) if mass[i] >= mass[j] else (j, i)
+        M = mass[keep] + mass[gone]
+        if M > 0:
+            for d in range(2):
+                pos[keep, d]     = (mass[keep] * pos[keep, d] + mass[gone] * pos[gone, d]) / M
+                pos_old[keep, d] = (mass[keep] * pos_old[keep, d] + mass[gone] * pos_old[gone, d]) / M
+                vel[keep, d]     = (mass[keep] * vel[keep, d] + mass[gone] * vel[gone, d]) / M
+                acc[keep, d]     = (mass[keep] * acc[keep, d] + mass[gone] * acc[gone, d]) / M
+        mass[keep]  = M
+        first[keep] = first[keep] or first[gone]
+        still[keep] = still[keep] or still[gone]
+        skip[gone]  = True
+        done[i] = done[j] = True
+        n += 1
+    return n
@@ -0,0 +1,201 @@
+"""
+Trajectory files: a header followed by one block per stored step, appended while the simulation runs.
+
+    header : MAGIC, uint64 length of the JSON metadata, JSON metadata padded to 8 bytes
+    block  : BLOCK header (b'STEP', step, t, n, fused), then every column of COLUMNS for the n bodies stored
+             one after the other, each one padded to 8 bytes
+
+The metadata holds the columns of the file, N_0, dt and the drawing radius and length unit of the bodies.
+"""
+import json
+import queue
+import struct
+import threading
+import numpy as np
+
+from Particle import ParticleSet
+
+
+global MAGIC, BLOCK, COLUMNS
+MAGIC   = b'NBODYTRJ'
+BLOCK   = struct.Struct('<4s4xqdqq')
+COLUMNS = (('ids', '<i8', ()), ('pos', '<f8', (2,)), ('vel', '<f8', (2,)), ('mass', '<f8', ()),
+           ('pos_old', '<f8', (2,)), ('first', '|b1', ()), ('skip', '|b1', ()), ('still', '|b1', ()),
+           ('color', '<f8', (3,)))
+
+
+def _column_sizes(columns, n):
+    """
+    Bytes taken by every column of a block of 'n' bodies, padding included.
+    """
+    return [(-(-n * int(np.prod(shape, dtype = np.int64)) * np.dtype(dtype).itemsize // 8)) * 8
+            for _, dtype, shape in columns]
+
+
+class SnapshotWriter():
+    """
+    Append the state of the bodies to a trajectory file from a background thread: write() only copies the
+    arrays and queues them, the thread does the file writes. At most 'depth' steps wait in the queue, then
+    write() blocks until the disk catches up.
+    """
+
+    def __init__(self, path, particles, N_0 = None, dt = None, depth = 4):
+        self.path = path
+        meta = dict(columns = [[name, dtype, list(shape)] for name, dtype, shape in COLUMNS],
+                    N_0 = len(particles) if N_0 is None else N_0, dt = dt, r = particles.r, to_len = particles.to_len)
+        text = json.dumps(meta).encode()
+        text += b' ' * (-len(text) % 8)
+
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + struct.pack('<Q', len(text)) + text)
+        self._queue  = queue.Queue(maxsize = depth)
+        self._error  = None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        self.n_written = 0
+
+    def write(self, particles, step, t, fused = 0):
+        """
+        Queue the current state of 'particles' as the block of 'step', at time 't'.
+        """
+        if self._error is not None:
+            raise self._error
+        arrays = [np.array(getattr(particles, name), dtype = dtype, order = 'C') for name, dtype, _ in COLUMNS]
+        self._queue.put((step, t, fused, arrays))
+        self.n_written += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            step, t, fused, arrays = item
+            n = len(arrays[0])
+            try:
+                self._file.write(BLOCK.pack(b'STEP', step, t, n, fused))
+                for a, size in zip(arrays, _column_sizes(COLUMNS, n)):
+                    self._file.write(memoryview(a).cast('B'))
+                    self._file.write(b'\0' * (size - a.nbytes))
+            except Exception as error:
+                self._error = error
+
+    def close(self):
+        """
+        Write all the queued steps and close the file.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Trajectory():
+    """
+    Read-only access to a trajectory file. Opening it only reads the header and hops over the block headers to
+    build the index, the arrays are memory-mapped on demand:
+            - steps, times, counts, fused : (n_blocks,) arrays describing every stored step
+            - frame(k)    : dict of the columns of the block k, as memory-mapped arrays
+            - particles(k): ParticleSet() holding a copy of the block k
+            - history(i)  : one column of the body with id 'i' along all the stored steps
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            if handle.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a trajectory file')
+            size, = struct.unpack('<Q', handle.read(8))
+            self.meta = json.loads(handle.read(size))
+            self.columns = [(name, dtype, tuple(shape)) for name, dtype, shape in self.meta['columns']]
+
+            file_size = handle.seek(0, 2)
+            steps, times, counts, fused, offsets = [], [], [], [], []
+            offset = len(MAGIC) + 8 + size
+            while True:
+                handle.seek(offset)
+                head = handle.read(BLOCK.size)
+                if len(head) < BLOCK.size:
+                    break
+                tag, step, t, n, f = BLOCK.unpack(head)
+                end = offset + BLOCK.size + sum(_column_sizes(self.columns, n))
+                if tag != b'STEP' or end > file_size:           # Last block still being written
+                    break
+                steps.append(step)
+                times.append(t)
+                counts.append(n)
+                fused.append(f)
+                offsets.append(offset + BLOCK.size)
+                offset = end
+
+        self.steps   = np.array(steps, dtype = np.int64)
+        self.times   = np.array(times)
+        self.counts  = np.array(counts, dtype = np.int64)
+        self.fused   = np.array(fused, dtype = np.int64)
+        self.offsets = np.array(offsets, dtype = np.int64)
+        self.N_0     = self.meta['N_0']
+
+    def __len__(self):
+        return len(self.steps)
+
+    def find(self, step):
+        """
+        Index of the block storing 'step'.
+        """
+        k = np.searchsorted(self.steps, step)
+        if k == len(self.steps) or self.steps[k] != step:
+            raise KeyError(f'step {step} not stored in {self.path}')
+        return int(k)
+
+    def frame(self, k, names = None):
+        """
+        Columns 'names' (all of them if None) of the block 'k', memory-mapped.
+        """
+        k = range(len(self))[k]
+        n = int(self.counts[k])
+        out = {}
+        offset = int(self.offsets[k])
+        for (name, dtype, shape), size in zip(self.columns, _column_sizes(self.columns, n)):
+            if (names is None or name in names) and n > 0:
+                out[name] = np.memmap(self.path, dtype = dtype, mode = 'r', offset = offset, shape = (n,) + shape)
+            elif names is None or name in names:
+                out[name] = np.zeros((0,) + shape, dtype = dtype)
+            offset += size
+        return out
+
+    def particles(self, k = -1):
+        """
+        ParticleSet() with the state of the block 'k'.
+        """
+        frame = self.frame(k)
+        out = ParticleSet(frame['pos'], frame['vel'], frame['mass'], self.meta['r'], frame['color'],
+                          self.meta['to_len'])
+        for name in ('ids', 'pos_old', 'first', 'skip', 'still'):
+            getattr(out, name)[:] = frame[name]
+        return out
+
+    def history(self, i, name = 'pos'):
+        """
+        Steps at which the body with id 'i' is stored and its column 'name' at those steps.
+        """
+        steps, values = [], []
+        for k in range(len(self)):
+            frame = self.frame(k, ('ids', name))
+            ids = frame['ids']
+            j = np.searchsorted(ids, i)
+            if j == len(ids) or ids[j] != i:                       # Ids are kept sorted, but check anyway
+                where = np.flatnonzero(ids == i)
+                if len(where) == 0:
+                    continue
+                j = where[0]
+            steps.append(self.steps[k])
+            values.append(np.array(frame[name][j]))
+        return np.array(steps, dtype = np.int64), np.array(values)
@@ -0,0 +1,77 @@
+import queue
+import subprocess
+import threading
+
+
+class VideoSink():
+    """
+    Encode the frames of the simulation with an ffmpeg subprocess. write() copies the raw RGB buffer of the
+    surface into a bounded queue and a background thread feeds it to the stdin of ffmpeg: with 'depth'
+    frames waiting write() blocks, so a slow encoder slows the loop down instead of filling the memory.
+    The format follows the extension of 'path': '.gif' (with an optimized palette) or '.mp4' (H.264).
+    """
+
+    def __init__(self, path, size, fps = 60, depth = 8):
+        self.path = path
+        self.size = size
+        if path.endswith('.gif'):
+            codec = ['-filter_complex', '[0:v]split[a][b];[a]palettegen[p];[b][p]paletteuse']
+        elif path.endswith('.mp4'):
+            codec = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p']
+        else:
+            raise ValueError(f'Unsupported video format: {path}')
+
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', f'{size[0]}x{size[1]}', '-r', str(fps), '-i', '-'] + codec + [path]
+        self._proc   = subprocess.Popen(command, stdin = subprocess.PIPE)
+        self._queue  = queue.Queue(maxsize = depth)
+        self._error  = None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        self.n_frames = 0
+
+    def write(self, SURF):
+        """
+        Queue the current content of the pygame surface 'SURF'.
+        """
+        import pygame as pg
+        if self._error is not None:
+            raise self._error
+        if SURF.get_size() != tuple(self.size):
+            raise ValueError(f'Frame of size {SURF.get_size()}, expected {tuple(self.size)}')
+        tobytes = getattr(pg.image, 'tobytes', None) or pg.image.tostring
+        self._queue.put(tobytes(SURF, 'RGB'))
+        self.n_frames += 1
+
+    def _run(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self._proc.stdin.write(frame)
+            except Exception as error:              # ffmpeg died, keep draining the queue
+                self._error = error
+
+    def close(self):
+        """
+        Encode the queued frames and wait for ffmpeg to finish the file.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self._proc.wait() != 0:
+            raise RuntimeError(f'ffmpeg failed writing {self.path}')
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,90 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+
+from numba import config
+
+
+global CONFIGS
+CONFIGS = (dict(engine = 'bh'),
+           dict(engine = 'bh', multipole = 2),
+           dict(engine = 'bh', leaf_size = 8),
+           dict(engine = 'bh', leaf_size = 8, multipole = 2),
+           dict(engine = 'bh', integrator = 'kdk'),
+           dict(engine = 'bh', precision = 'float32'),
+           dict(engine = 'bh', leaf_size = 8, multipole = 2, precision = 'float32'),
+           dict(engine = 'fmm', leaf_size = 8),
+           dict(engine = 'direct'))
+
+def warm_up(N_0 = 256, verbose = True):
+    """
+    Compile all the kernels into the on-disk cache of numba (the __pycache__ directories next to the sources,
+    or NUMBA_CACHE_DIR), so that later processes load them instead of compiling them. A few steps of a small
+    simulation run through every setting in CONFIGS, with mergers, compaction, diagnostics and the counts of
+    the profiler, and the bodies and the tree are drawn in every mode of the renderer if pygame is installed.
+    Numba recompiles a cached kernel only when its own source file changes: a change that reaches a kernel from
+    another module (a constant assigned at run time, such as Gravity.a2 = ..., or a function or value
+    imported from a module that was edited) is not noticed, and the stale kernel keeps running. After such a
+    change clear the cache with clear_cache() (python Warmup.py --clear). Returns the seconds spent.
+    """
+    t0 = time.time()
+    from Diagnostics import Diagnostics
+    from Gravity import DirectForces
+    from InitialCond import Compute_IC
+    from Profiler import Profiler
+    from Simulation import Simulation
+
+    for settings in CONFIGS:
+        t1 = time.time()
+        sim = Simulation(Compute_IC(N_0, seed = 1, cache = None), profiler = Profiler(count_every = 1),
+                         merge_radius = 0.5, compact_every = 2, **settings)
+        diagnostics = Diagnostics(every = 1)
+        for _ in range(2):
+            sim.step()
+            diagnostics.record(sim)
+            sim.profiler.end_step(sim.n_step)
+        if verbose:
+            print(f'{str(settings):<45} {time.time() - t1:7.2f} s')
+    DirectForces(sim.particles, np.arange(0, len(sim.particles), 2))
+
+    try:
+        import pygame as pg
+    except ImportError:
+        pg = None
+    if pg is not None:
+        from Render import Renderer
+        t1 = time.time()
+        SURF = pg.Surface((64, 64))
+        p = sim.particles
+        for mode in ('color', 'mass', 'density'):
+            Renderer(mode, size = (64, 64)).draw(SURF, p.pos, p.skip, p.color, p.mass, sim.updateTree().boxes())
+        if verbose:
+            print(f'{"renderer":<45} {time.time() - t1:7.2f} s')
+
+    if verbose:
+        print(f'Kernels compiled and cached in {time.time() - t0:.1f} s')
+    return time.time() - t0
+
+def clear_cache():
+    """
+    Delete the compiled kernels of this directory from the cache of numba. Returns the number of files removed.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    base = os.path.join(config.CACHE_DIR, '**') if config.CACHE_DIR else os.path.join(root, '__pycache__')
+    modules = [os.path.basename(path)[:-3] for path in glob.glob(os.path.join(root, '*.py'))]
+    files = [path for module in modules for ext in ('nbi', 'nbc')
+             for path in glob.glob(os.path.join(base, f'{module}.*.{ext}'), recursive = True)]
+    for path in files:
+        os.remove(path)
+    return len(files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Compile all the kernels into the cache of numba.')
+    parser.add_argument('--clear', action = 'store_true', help = 'delete the cached kernels before compiling them')
+    args = parser.parse_args()
+    if args.clear:
+        print(f'Removed {clear_cache()} cached files')
+    warm_up()
@@ -0,0 +1,215 @@
+import queue
+import multiprocessing as mp
+import numpy as np
+
+from multiprocessing import shared_memory
+
+
+class SharedState():
+    """
+    Double buffer in shared memory holding the state published by the physics worker: two copies of the
+    positions, masses, flags and colors of the bodies and of the squares of the tree. The worker writes the back copy
+    and swaps it with the front one under 'lock', readers copy the front one under the same lock, so they
+    always get a complete step.
+    """
+
+    def __init__(self, capacity, max_boxes, lock, name = None):
+        self.capacity  = capacity
+        self.max_boxes = max_boxes
+        self.lock      = lock
+        layout = [('front', np.int64, (1,)),
+                  ('header', np.int64, (2, 3)),                   # n bodies, n boxes, step
+                  ('time', np.float64, (2,)),
+                  ('pos', np.float64, (2, capacity, 2)),
+                  ('color', np.float64, (2, capacity, 3)),
+                  ('mass', np.float64, (2, capacity)),
+                  ('skip', np.bool_, (2, capacity)),
+                  ('boxes', np.float64, (2, max_boxes, 3))]
+        size = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, dtype, shape in layout)
+
+        self.shm = shared_memory.SharedMemory(name = name, create = name is None, size = size)
+        self.name = self.shm.name
+        offset = 0
+        for field, dtype, shape in layout:
+            setattr(self, field, np.ndarray(shape, dtype = dtype, buffer = self.shm.buf, offset = offset))
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if name is None:
+            self.front[0] = 0
+            self.header[:] = 0
+
+    def publish(self, sim, boxes = False):
+        """
+        Write the current state of the Simulation() 'sim' in the back copy and make it the front one.
+        The squares of the tree are written only if 'boxes'.
+        """
+        p = sim.particles
+        back = 1 - self.front[0]
+        n = min(len(p), self.capacity)
+        self.pos[back, :n]   = p.pos[:n]
+        self.color[back, :n] = p.color[:n]
+        self.mass[back, :n]  = p.mass[:n]
+        self.skip[back, :n]  = p.skip[:n]
+        n_boxes = 0
+        if boxes and sim.tree is not None:
+            b = sim.tree.boxes()
+            n_boxes = min(len(b), self.max_boxes)
+            self.boxes[back, :n_boxes] = b[:n_boxes]
+        self.header[back] = n, n_boxes, sim.n_step
+        self.time[back] = sim.t
+        with self.lock:
+            self.front[0] = back
+
+    def read(self):
+        """
+        Copy of the front state: dict with step, t, pos, color, mass, skip and boxes.
+        """
+        with self.lock:
+            f = self.front[0]
+            n, n_boxes, step = self.header[f]
+            return dict(step = int(step), t = float(self.time[f]), pos = self.pos[f, :n].copy(),
+                        color = self.color[f, :n].copy(), mass = self.mass[f, :n].copy(),
+                        skip = self.skip[f, :n].copy(), boxes = self.boxes[f, :n_boxes].copy())
+
+    def close(self, unlink = False):
+        for field in ('front', 'header', 'time', 'pos', 'color', 'mass', 'skip', 'boxes'):
+            delattr(self, field)
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class PhysicsWorker():
+    """
+    Run a Simulation() in its own process, as fast as the cores allow, publishing every step in a SharedState()
+    that the front end reads at its own rate through read(). The front end drives the worker with the commands
+    'pause', 'resume', 'tree' / 'notree' (publish the squares of the tree or not) and 'quit'.
+    Without a front end the worker runs until 'steps' steps are done, see join().
+    """
+
+    def __init__(self, particles = None, snapshot = None, settings = None, output = None, save_every = 10,
+                 steps = None, boxes = False, diagnostics = None, diag_every = 10, profile = False, profile_log = None):
+        """
+            - particles, snapshot : initial conditions, ParticleSet() or trajectory file to resume from
+            - settings            : keyword arguments of Simulation()
+            - output, save_every  : trajectory file written by the worker and its cadence in steps
+            - steps               : stop after this number of steps, None to run until 'quit'
+            - boxes               : publish the squares of the tree from the start
+            - diagnostics, diag_every : .csv or .jsonl file of the Diagnostics() written by the worker, and its
+                                    cadence in steps
+            - profile, profile_log : time the phases of the steps in the worker, see Profiler()
+        """
+        if snapshot is not None:
+            from Snapshot import Trajectory
+            capacity = int(Trajectory(snapshot).counts[-1])
+        else:
+            capacity = len(particles)
+
+        ctx = mp.get_context('spawn')
+        self.state    = SharedState(capacity, 8 * capacity + 4, ctx.Lock())
+        self.commands = ctx.Queue()
+        self.results  = ctx.Queue()
+        self.process  = ctx.Process(target = _physics, daemon = True,
+                                    args = (self.state.name, capacity, self.state.max_boxes, self.state.lock,
+                                            self.commands, self.results, particles, snapshot, settings or {},
+                                            output, save_every, steps, boxes, diagnostics, diag_every, profile,
+                                            profile_log))
+        self.process.start()
+
+    def send(self, command):
+        self.commands.put(command)
+
+    def read(self):
+        return self.state.read()
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def join(self):
+        """
+        Wait for the worker to stop. Returns the final ParticleSet() and a report with the statistics of the tree
+        and the profile of the steps.
+        """
+        result = self.results.get()
+        self.process.join()
+        self.state.close(unlink = True)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def quit(self):
+        self.send('quit')
+        return self.join()
+
+
+def _physics(name, capacity, max_boxes, lock, commands, results, particles, snapshot, settings, output, save_every,
+             steps, boxes, diagnostics, diag_every, profile, profile_log):
+    """
+    Main function of the worker process, see PhysicsWorker().
+    """
+    from Diagnostics import Diagnostics
+    from Profiler import Profiler
+    from Simulation import Simulation
+    state = SharedState(capacity, max_boxes, lock, name)
+    writer = None
+    profiler = Profiler(profile_log, profile or profile_log is not None)
+    settings = dict(settings, profiler = profiler)
+    try:
+        if snapshot is not None:
+            sim = Simulation.from_snapshot(snapshot, **settings)
+        else:
+            sim = Simulation(particles, **settings)
+        if output is not None:
+            writer = sim.writer(output)
+            sim.save(writer)
+        if diagnostics is not None:
+            diagnostics = Diagnostics(diagnostics, diag_every)
+            diagnostics.record(sim, force = True)
+
+        paused, run, n = False, True, 0
+        while run and (steps is None or n < steps):
+            while True:                                             # Block on the commands while paused
+                try:
+                    command = commands.get(block = paused)
+                except queue.Empty:
+                    break
+                if command == 'quit':
+                    run = False
+                    break
+                paused = {'pause': True, 'resume': False}.get(command, paused)
+                boxes  = {'tree': True, 'notree': False}.get(command, boxes)
+                state.publish(sim, boxes)                           # Show a tree toggle at once, even if paused
+            if not run:
+                break
+
+            if boxes:
+                sim.updateTree()                                    # Otherwise only the tree engines need it
+            with profiler.timer('publish'):
+                state.publish(sim, boxes)
+            sim.advance()
+            n += 1
+            if writer is not None and n % save_every == 0:
+                with profiler.timer('save'):
+                    sim.save(writer)
+            if diagnostics is not None:
+                with profiler.timer('diagnostics'):
+                    diagnostics.record(sim)
+            profiler.end_step(sim.n_step)
+
+        if writer is not None:
+            if n % save_every != 0:
+                sim.save(writer)
+            writer.close()
+        if diagnostics is not None:
+            diagnostics.close()
+        profiler.close()
+        report = f'Removed bodies: {sim.n_removed} ({sim.n_escaped} escaped), {sim.fused} mergers'
+        if sim.currentEngine() != 'direct':
+            report = sim.updateTree().stats() + '\n' + report
+        if profiler.enabled:
+            report += '\n' + profiler.summary('Physics profile')
+        results.put((sim.particles, report))
+    except Exception as error:
+        results.put(error)
+    finally:
+        state.close()
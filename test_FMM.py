@@ -0,0 +1,19 @@
+import numpy as np
+
+from Gravity import DirectForces
+from InitialCond import Compute_IC
+from Simulation import Simulation
+
+
+def test_fmm_accuracy():
+    """
+    Forces of the FMM with the default settings of Simulation() against the direct sum.
+    """
+    sim = Simulation(Compute_IC(2000, seed = 10000, cache = None), engine = 'fmm')
+    p = sim.particles
+    DirectForces(p)
+    reference = p.acc.copy()
+    sim.computeForces()
+    err = np.linalg.norm(p.acc - reference, axis = 1) / np.linalg.norm(reference, axis = 1)
+    assert np.sqrt(np.mean(err**2)) < 0.05
+    assert np.percentile(err, 99) < 0.15
@@ -0,0 +1,22 @@
+import numpy as np
+
+from InitialCond import Compute_IC
+from Simulation import Simulation
+
+
+def test_refit_with_buckets():
+    """
+    With leaves of several bodies the default 'max_leaf' leaves room for the refit, and the refitted leaves
+    still hold all their bodies inside their boxes.
+    """
+    sim = Simulation(Compute_IC(1000, seed = 1, cache = None), leaf_size = 8)
+    for _ in range(10):
+        sim.step()
+    tree = sim.updateTree()
+    assert tree.n_refits > 0
+
+    pos = sim.particles.pos
+    for node in np.flatnonzero(tree.node_leaf):
+        body = tree.order[tree.node_start[node]:tree.node_end[node]]
+        h = tree.node_w[node] / 2
+        assert np.all(np.abs(pos[body] - tree.node_center[node]) <= h)